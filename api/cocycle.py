@@ -3,7 +3,7 @@ from itertools import product
 from numpy import zeros, array, equal as npequal
 from tqdm import tqdm
 
-from loopapy.loop import Loop
+from loopapy.loop import Loop, Subset
 
 
 class Partition:
@@ -59,13 +59,13 @@ class Partition:
         return need
 
     def closure(self, ks):
-        close = set()
-        new_close = set(ks)
+        close = Subset(0, self.qcard)
+        new_close = Subset.from_elements(list(ks), self.qcard)
         while new_close != close:
             close = new_close
             for i, j in product(close, repeat=2):
-                new_close = new_close.union(self.closure_ij(i, j))
-        return close
+                new_close = new_close | Subset.from_elements(list(self.closure_ij(i, j)), self.qcard)
+        return set(int(k) for k in close)
 
     def mul(self, t1, t2):
         b = self.B.order - 1
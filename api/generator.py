@@ -1,13 +1,15 @@
 from __future__ import annotations
 
 from itertools import product
+from os import replace
 from os.path import isfile
 
-from numpy import array, zeros, ones, loadtxt
-from numpy.random import RandomState
+from numpy import array, zeros, ones, loadtxt, arange, nonzero
+from numpy.random import RandomState, Generator
 
-from loopapy.loop import Loop, EmptyLoop
+from loopapy.loop import Loop, LoopBatch
 from loopapy.setup import THIS_DIR
+from loopy.table import code_dtype
 
 
 class LoopGenerator:
@@ -34,24 +36,37 @@ class CentralExtensionGenerator:
 
     @staticmethod
     def generate(A: Loop, B: Loop, theta: array, phi: array = None) -> Loop:
-        a = A.order
-        b = B.order
+        """
+        (a1, b1) * (a2, b2) = ((a1 * phi[b1, a2]) * theta[b1, b2], b1 * b2) where (a, b) is encoded as a * |B| + b
+        """
+        return Loop(CentralExtensionGenerator.extension_tables(A, B, theta[None, :, :], phi)[0].astype(int))
 
-        AB = EmptyLoop(a * b)
-        AB_to_index = {(a, b): i for i, (a, b) in enumerate(product(A.elements, B.elements))}
+    @staticmethod
+    def extension_tables(A: Loop, B: Loop, thetas: array, phi: array = None) -> array:
+        """
+        Stacked version of generate, the tables are computed by broadcasting over the axes (theta, a1, b1, a2, b2)
+        :param thetas: stacked thetas, of shape (K, |B|, |B|)
+        :return: the stacked mul tables of the extensions, of shape (K, |A||B|, |A||B|), in the smallest unsigned
+        dtype able to hold the elements (see loopy.table.code_dtype)
+        """
+        n = A.order * B.order
+        dtype = code_dtype(n)
 
-        for a1, a2 in product(A.elements, repeat=2):
-            for b1, b2 in product(B.elements, repeat=2):
-                x = AB_to_index[(a1, b1)]
-                y = AB_to_index[(a2, b2)]
+        k = arange(thetas.shape[0])[:, None, None, None, None]
+        a1 = A.elements[None, :, None, None, None]
+        b1 = B.elements[None, None, :, None, None]
+        a2 = A.elements[None, None, None, :, None]
+        b2 = B.elements[None, None, None, None, :]
 
-                phi_a2 = a2 if phi is None else phi[b1, a2]
+        phi_a2 = a2 if phi is None else phi[b1, a2]
 
-                prod = (A.mul(A.mul(a1, phi_a2), theta[b1, b2]), B.mul(b1, b2))
-                xy = AB_to_index[prod]
-                AB.update_mul(x, y, xy)
+        # only the (K, |A|, |B|, |A|, |B|) arrays are large, they are gathered in the compact dtype
+        prod_a = A.tmul.astype(dtype)[A.tmul[a1, phi_a2], thetas[k, b1, b2]]
+        prod_b = B.tmul[b1, b2]
 
-        return AB
+        # code[a, b] = a |B| + b, the element (a, b) of A x B
+        code = arange(n, dtype=dtype).reshape(A.order, B.order)
+        return code[prod_a, prod_b].reshape(-1, n, n)
 
     @staticmethod
     def random_theta(a: int, b: int, rng: RandomState):
@@ -59,6 +74,31 @@ class CentralExtensionGenerator:
         theta[1:, 1:] = rng.randint(a, size=(b - 1, b - 1))
         return theta
 
+    @staticmethod
+    def random_thetas(a: int, b: int, size: int, rng: Generator) -> array:
+        """
+        :return: size random thetas drawn at once, of shape (size, b, b)
+        """
+        thetas = zeros((size, b, b), dtype=int)
+        thetas[:, 1:, 1:] = rng.integers(a, size=(size, b - 1, b - 1))
+        return thetas
+
+    @staticmethod
+    def random_batch(A: Loop, B: Loop, size: int, rng: Generator, phi: array = None,
+                     predicate=None) -> [array, LoopBatch]:
+        """
+        Draw size random thetas and generate all their extensions at once
+        :param predicate: optional vectorized property, function LoopBatch -> boolean mask (e.g. LoopBatch.is_loop),
+        used to filter the extensions before any Loop is built
+        :return: the thetas and the LoopBatch of the extensions satisfying predicate
+        """
+        thetas = CentralExtensionGenerator.random_thetas(A.order, B.order, size, rng)
+        batch = LoopBatch(CentralExtensionGenerator.extension_tables(A, B, thetas, phi))
+        if predicate is not None:
+            mask = predicate(batch)
+            thetas, batch = thetas[mask], batch.select(mask)
+        return thetas, batch
+
     @staticmethod
     def space_size(A: Loop, B: Loop, fmt="%s"):
         n = (B.order - 1) ** 2
@@ -68,6 +108,104 @@ class CentralExtensionGenerator:
             return A.order ** n
 
 
+class CocycleEnumerator:
+    """
+    Enumerate all the thetas of CentralExtensionGenerator, or those of a sub-lattice, in a deterministic order.
+    The theta of index i has the digits of i in base |A| on its free coordinates (in row-major order, the last one
+    being the least significant), and the coordinates of base elsewhere.
+    """
+
+    def __init__(self, A: Loop, B: Loop, free: array = None, base: array = None, phi: array = None):
+        """
+        :param free: boolean mask of shape (|B|, |B|) of the enumerated coordinates, theta[1:, 1:] by default
+        :param base: values of the coordinates that are not free, 0 by default
+        :param phi: see CentralExtensionGenerator.generate
+        """
+        self.A = A
+        self.B = B
+        self.phi = phi
+
+        if free is None:
+            free = zeros((B.order, B.order), dtype=bool)
+            free[1:, 1:] = True
+        self.free = free
+        self.base = zeros((B.order, B.order), dtype=int) if base is None else base
+
+        self.rows, self.columns = nonzero(self.free)
+        self.nb_digits = self.rows.size
+        self.size = A.order ** self.nb_digits  # Python int, it may not fit in 64 bits
+
+    def shard(self, worker: int, nb_workers: int) -> [int, int]:
+        """
+        :return: the range [start, stop) of the indexes enumerated by worker, among nb_workers
+        """
+        return self.size * worker // nb_workers, self.size * (worker + 1) // nb_workers
+
+    def thetas(self, start: int, stop: int) -> array:
+        """
+        :return: the thetas of indexes start, ..., stop - 1, of shape (stop - start, |B|, |B|)
+        """
+        a = self.A.order
+        count = stop - start
+        start_digits = []
+        for _ in range(self.nb_digits):
+            start, digit = divmod(start, a)
+            start_digits.append(digit)
+
+        # adding the offsets to the digits of start, from the least significant one
+        digits = zeros((count, self.nb_digits), dtype=int)
+        carry = arange(count)
+        for d in range(self.nb_digits):
+            carry, digits[:, self.nb_digits - 1 - d] = divmod(start_digits[d] + carry, a)
+
+        thetas = zeros((count, self.B.order, self.B.order), dtype=int)
+        thetas[:] = self.base
+        thetas[:, self.rows, self.columns] = digits
+        return thetas
+
+    def enumerate(self, start: int = 0, stop: int = None, chunk_size: int = 1 << 12, checkpoint: str = None,
+                  checkpoint_every: int = 1):
+        """
+        Lazily generate the extensions of the thetas of indexes start, ..., stop - 1 by chunks
+        :param checkpoint: optional file name. The index of the next chunk to generate is written to it every
+        checkpoint_every chunks, once the previous chunk has been consumed, and the enumeration resumes from it if
+        it already exists. A chunk being processed during a crash is thus generated again after the restart.
+        :return: generator of (index, thetas, batch) where index is the index of thetas[0] and batch the LoopBatch of
+        the extensions
+        """
+        if stop is None:
+            stop = self.size
+        if checkpoint is not None and isfile(checkpoint):
+            start = self.read_checkpoint(checkpoint, start, stop)
+
+        index = start
+        nb_chunks = 0
+        while index < stop:
+            chunk_stop = min(stop, index + chunk_size)
+            thetas = self.thetas(index, chunk_stop)
+            yield index, thetas, LoopBatch(CentralExtensionGenerator.extension_tables(self.A, self.B, thetas, self.phi))
+
+            index = chunk_stop
+            nb_chunks += 1
+            if checkpoint is not None and (nb_chunks % checkpoint_every == 0 or index == stop):
+                self.write_checkpoint(checkpoint, index)
+
+    @staticmethod
+    def write_checkpoint(fname: str, index: int):
+        temp_fname = fname + ".tmp"
+        with open(temp_fname, "w") as file:
+            file.write(f"{index}\n")
+        replace(temp_fname, fname)  # atomic, a crash never leaves a half-written checkpoint
+
+    @staticmethod
+    def read_checkpoint(fname: str, start: int, stop: int) -> int:
+        with open(fname, "r") as file:
+            index = int(file.read())
+        if not start <= index <= stop:
+            raise Exception(f"The checkpoint {fname} ({index}) is not in the range [{start}, {stop}]")
+        return index
+
+
 class CsorgoTypeGenerator:
     def __init__(self):
         pass
@@ -3,12 +3,177 @@ from __future__ import annotations
 from ast import literal_eval
 from itertools import product
 
-from numpy import array, where, isin, intersect1d, zeros, setdiff1d, loadtxt, savetxt
+from numpy import array, where, isin, zeros, loadtxt, savetxt, arange, ones, sort, unique, ix_, full, add, \
+    concatenate, ravel_multi_index, unravel_index, put_along_axis, broadcast_to, stack, ascontiguousarray, packbits, \
+    unpackbits, frombuffer, uint8
+
+from loopy.table import code_dtype
+
+# maximum number of booleans of the associator array computed at once
+ASSOCIATOR_BLOCK_SIZE = 1 << 24
+
+
+def associator_blocks(tables: array, block_size: int = ASSOCIATOR_BLOCK_SIZE):
+    """
+    Compute the associator arrays A[b, x, y, z] = (x*y)*z == x*(y*z) of a stack of tables by blocks of consecutive
+    tables and consecutive x, so that the peak memory stays bounded by block_size booleans
+    :param tables: stacked multiplication tables, of shape (batch, n, n)
+    :return: generator of (b_start, x_start, block) where block[k, i, y, z] = A[b_start + k, x_start + i, y, z]
+    """
+    batch, n = tables.shape[0], tables.shape[-1]
+    x_chunk = max(1, min(n, block_size // n ** 2))
+    b_chunk = max(1, block_size // (x_chunk * n ** 2))
+    z = arange(n)[None, None, None, :]
+    for b_start in range(0, batch, b_chunk):
+        t = tables[b_start:b_start + b_chunk]
+        b = arange(t.shape[0])[:, None, None, None]
+        for x_start in range(0, n, x_chunk):
+            xs = arange(x_start, min(n, x_start + x_chunk))
+            xy_z = t[b, t[:, xs, :, None], z]
+            x_yz = t[b, xs[None, :, None, None], t[:, None, :, :]]
+            yield b_start, x_start, xy_z == x_yz
+
+
+def associator_failures(tables: array) -> [array, array, array]:
+    """
+    :param tables: stacked multiplication tables, of shape (batch, n, n)
+    :return: the number of triples (x, y, z) such that (x*y)*z != x*(y*z) for each x, y and z, i.e. the left,
+    middle and right counts, of shape (batch, n), computed in one pass over the associator
+    """
+    left = zeros(tables.shape[:2], dtype=int)
+    middle = zeros(tables.shape[:2], dtype=int)
+    right = zeros(tables.shape[:2], dtype=int)
+    for b_start, x_start, block in associator_blocks(tables):
+        b_stop, x_stop = b_start + block.shape[0], x_start + block.shape[1]
+        failures = ~block
+        left[b_start:b_stop, x_start:x_stop] = failures.sum(axis=(2, 3))
+        middle[b_start:b_stop] += failures.sum(axis=(1, 3))
+        right[b_start:b_stop] += failures.sum(axis=(1, 2))
+    return left, middle, right
+
+
+def nuclei_masks(tables: array) -> [array, array, array]:
+    """
+    :param tables: stacked multiplication tables, of shape (batch, n, n)
+    :return: the boolean masks of the left, middle and right nuclei, of shape (batch, n)
+    """
+    return tuple(failures == 0 for failures in associator_failures(tables))
+
+
+def commutant_masks(tables: array) -> array:
+    """
+    :param tables: stacked multiplication tables, of shape (batch, n, n)
+    :return: the boolean masks of the commutants, of shape (batch, n)
+    """
+    return (tables == tables.transpose(0, 2, 1)).all(axis=2)
+
+
+def divisions(tables: array) -> [array, array]:
+    """
+    Fill the ld and rd tables of a stack of tables by inverse scatter : x \\ (x*y) = y and (x*y) / y = x
+    :param tables: stacked multiplication tables, of shape (batch, n, n)
+    :return: the stacked ld and rd tables, of the dtype of tables
+    """
+    elements = arange(tables.shape[-1], dtype=tables.dtype)
+    tld = zeros(tables.shape, dtype=tables.dtype)
+    trd = zeros(tables.shape, dtype=tables.dtype)
+    put_along_axis(tld, tables, broadcast_to(elements[None, None, :], tables.shape), axis=2)
+    put_along_axis(trd, tables, broadcast_to(elements[None, :, None], tables.shape), axis=1)
+    return tld, trd
+
+
+def are_loops(tables: array) -> array:
+    """
+    Validate a stack of tables at once : a table is a loop table if its first row and column are 0, ..., n-1 and if
+    each of its rows and columns, once sorted, is 0, ..., n-1
+    :param tables: stacked multiplication tables, of shape (batch, n, n)
+    :return: the boolean mask of the loop tables, of shape (batch,)
+    """
+    n = tables.shape[-1]
+    elements = arange(n)
+    identity = (tables[:, 0, :] == elements).all(axis=1) & (tables[:, :, 0] == elements).all(axis=1)
+    rows = (sort(tables, axis=2) == elements[None, None, :]).all(axis=(1, 2))
+    columns = (sort(tables, axis=1) == elements[None, :, None]).all(axis=(1, 2))
+    return identity & rows & columns
+
+
+class Subset:
+    """
+    Subset of the elements 0, ..., order-1 of a loop, stored as the bits of a Python int : union, intersection,
+    inclusion and equality work on whole machine words
+    """
+
+    def __init__(self, bits: int, order: int):
+        self.bits = bits
+        self.order = order
+
+    @staticmethod
+    def from_mask(mask: array) -> Subset:
+        return Subset(int.from_bytes(packbits(mask, bitorder="little").tobytes(), "little"), mask.shape[0])
+
+    @staticmethod
+    def from_elements(elements, order: int) -> Subset:
+        mask = zeros(order, dtype=bool)
+        mask[elements] = True
+        return Subset.from_mask(mask)
+
+    @staticmethod
+    def packed_rows(elements: array, order: int) -> array:
+        """
+        :param elements: array of elements of shape (k, m)
+        :return: the k subsets of the rows of elements, as packed bitsets of shape (k, ceil(order / 8))
+        """
+        masks = zeros((elements.shape[0], order), dtype=bool)
+        put_along_axis(masks, elements, True, axis=1)
+        return packbits(masks, axis=1, bitorder="little")
+
+    def mask(self) -> array:
+        packed = frombuffer(self.bits.to_bytes((self.order + 7) // 8, "little"), dtype=uint8)
+        return unpackbits(packed, count=self.order, bitorder="little").astype(bool)
+
+    def elements(self) -> array:
+        return arange(self.order)[self.mask()]
+
+    def __or__(self, other: Subset) -> Subset:
+        return Subset(self.bits | other.bits, self.order)
+
+    def __and__(self, other: Subset) -> Subset:
+        return Subset(self.bits & other.bits, self.order)
+
+    def __sub__(self, other: Subset) -> Subset:
+        return Subset(self.bits & ~other.bits, self.order)
+
+    def __le__(self, other: Subset) -> bool:
+        return self.bits & ~other.bits == 0
+
+    def __contains__(self, x: int) -> bool:
+        return (self.bits >> int(x)) & 1 == 1
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Subset) and self.bits == other.bits and self.order == other.order
+
+    def __hash__(self):
+        return hash((self.bits, self.order))
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __iter__(self):
+        return iter(self.elements())
+
+    def __str__(self):
+        return str(self.elements())
+
+    def __repr__(self):
+        return f"Subset({self})"
 
 
 class Loop:
     """
-    API for ld, rd and mul of a loop
+    API for ld, rd and mul of a loop.
+    The invariants are cached on the instance. update_mul keeps the per-element associator and commutant failure
+    counts up to date in O(n^2) and drops the other ones, so the tables must only be changed with update_mul,
+    or invalidate must be called afterwards. A frozen loop can't be updated anymore.
     """
 
     def __init__(self, mul_table: array):
@@ -20,17 +185,87 @@ class Loop:
         self.tmul = mul_table
         self.elements = array([i for i in range(self.order)])
 
-        self.trd = zeros((self.order, self.order), dtype=int)
-        self.tld = zeros((self.order, self.order), dtype=int)
+        tld, trd = divisions(self.tmul[None, :, :])
+        self.tld = tld[0]
+        self.trd = trd[0]
 
-        for x, y in product(self.elements, repeat=2):
-            self.update_mul(x, y, self.mul(x, y))
+        self.frozen = False
+        self._invariants = {}
 
     def update_mul(self, x, y, z):
+        if self.frozen:
+            raise Exception("This loop is frozen, its table can't be updated")
+
+        old = self.tmul[x, y]
+        triples = self._associator_triples(x, y) if "associator_failures" in self._invariants else None
+        if triples is not None:
+            self._count_associator_failures(triples, -1)
+        if "commutant_failures" in self._invariants:
+            self._count_commutant_failures(x, y, -1)
+
         self.tmul[x, y] = z  # x * y = z
         self.tld[x, z] = y  # x \ z = y
         self.trd[z, y] = x  # z / y = x
 
+        if triples is not None:
+            self._count_associator_failures(triples, 1)
+        if "commutant_failures" in self._invariants:
+            self._count_commutant_failures(x, y, 1)
+        if old != z:
+            for key in ("is_loop", "is_associative", "upper_central_series", "subloops"):
+                self._invariants.pop(key, None)
+
+    def invalidate(self):
+        """
+        Forget all the cached invariants, to call if the tables were changed without update_mul
+        """
+        self._invariants = {}
+
+    def freeze(self) -> Loop:
+        """
+        Make the tables of the loop read-only (after copying the mul table, which may be shared)
+        :return: self
+        """
+        if not self.frozen:
+            self.tmul = self.tmul.copy()
+            for table in (self.tmul, self.tld, self.trd):
+                table.flags.writeable = False
+            self.frozen = True
+        return self
+
+    def _cached(self, key: str, compute):
+        if key not in self._invariants:
+            self._invariants[key] = compute()
+        return self._invariants[key]
+
+    def _associator_triples(self, x, y) -> array:
+        """
+        :return: the triples (a, b, c) whose associator reads the cell x*y, whatever its value, as three arrays
+        """
+        n = self.order
+        elements = self.elements
+        ab_x = where(self.tmul == x)  # (a*b)*y with a*b = x
+        bc_y = where(self.tmul == y)  # x*(b*c) with b*c = y
+        a = concatenate([full(n, x), ab_x[0], elements, full(bc_y[0].size, x)])
+        b = concatenate([full(n, y), ab_x[1], full(n, x), bc_y[0]])
+        c = concatenate([elements, full(ab_x[0].size, y), full(n, y), bc_y[1]])
+        return unravel_index(unique(ravel_multi_index((a, b, c), (n, n, n))), (n, n, n))
+
+    def _count_associator_failures(self, triples, sign: int):
+        a, b, c = triples
+        t = self.tmul
+        failures = (t[t[a, b], c] != t[a, t[b, c]]).astype(int) * sign
+        left, middle, right = self._invariants["associator_failures"]
+        add.at(left, a, failures)
+        add.at(middle, b, failures)
+        add.at(right, c, failures)
+
+    def _count_commutant_failures(self, x, y, sign: int):
+        if x != y and self.tmul[x, y] != self.tmul[y, x]:
+            failures = self._invariants["commutant_failures"]
+            failures[x] += sign
+            failures[y] += sign
+
     def mul(self, x, y):
         return self.tmul[x, y]
 
@@ -56,38 +291,27 @@ class Loop:
         return str(self)
 
     def is_loop(self) -> bool:
-        n = self.order
-        if not (self.tmul[:, 0] == self.elements).all() or not (self.tmul[0, :] == self.elements).all():
-            return False
+        return self._cached("is_loop", lambda: bool(are_loops(self.tmul[None, :, :])[0]))
 
-        for i in range(n):
-            if not isin(self.tmul[i, :], self.elements).all():
-                return False
-            if not isin(self.tmul[:, i], self.elements).all():
-                return False
+    def is_associative(self) -> bool:
+        if "associator_failures" in self._invariants:
+            return not self._invariants["associator_failures"][0].any()
+        return self._cached("is_associative", self._is_associative)
 
-            if len(set(self.tmul[i, :])) != n:
+    def _is_associative(self) -> bool:
+        for _, _, block in associator_blocks(self.tmul[None, :, :]):
+            if not block.all():
                 return False
-            if len(set(self.tmul[:, i])) != n:
-                return False
-
         return True
 
-    def is_associative(self) -> bool:
-        for x, y, z in product(self.elements, repeat=3):
-            if self.mul(x, self.mul(y, z)) != self.mul(self.mul(x, y), z):
-                return False
-        return True
+    def commutant_failures(self) -> array:
+        """
+        :return: the number of y such that x*y != y*x for each x
+        """
+        return self._cached("commutant_failures", lambda: (self.tmul != self.tmul.T).sum(axis=1))
 
     def commutant(self) -> array:
-        elements = []
-        for x in self.elements:
-            for y in self.elements:
-                if self.mul(x, y) != self.mul(y, x):
-                    break
-            else:  # no break
-                elements.append(x)
-        return array(elements)
+        return self.elements[self.commutant_failures() == 0]
 
     def is_commutative(self) -> bool:
         commutant = set(self.commutant())
@@ -103,135 +327,184 @@ class Loop:
         return new_table[indexes, :]
 
     def is_subloop(self, subloop_elements: array) -> bool:
-        for x, y in product(subloop_elements, repeat=2):
-            if self.mul(x, y) not in subloop_elements:
-                return False
+        S = Subset.from_elements(subloop_elements, self.order)
+        if not Subset.from_elements(self.tmul[ix_(subloop_elements, subloop_elements)].ravel(), self.order) <= S:
+            return False
         subloop_mul_table = self.sub_table(subloop_elements)
         return GeneralizedLoop(subloop_mul_table, subloop_elements).is_loop()
 
+    def generated_subloop(self, generators, closed: Subset = None) -> array:
+        """
+        Close {0} and the generators under mul, ld and rd, each round only combining the elements added by the
+        previous one with the elements found so far
+        :param generators: array of elements
+        :param closed: optional Subset of a subloop included in the result, to start the closure from
+        :return: the elements of the subloop generated by generators (and closed)
+        """
+        mask = zeros(self.order, dtype=bool) if closed is None else closed.mask()
+        new = zeros(self.order, dtype=bool)
+        new[0] = True
+        new[generators] = True
+        new &= ~mask
+        while new.any():
+            mask |= new
+            S, N = self.elements[mask], self.elements[new]
+            found = zeros(self.order, dtype=bool)
+            for table in (self.tmul, self.tld, self.trd):
+                found[table[ix_(N, S)]] = True
+                found[table[ix_(S, N)]] = True
+            new = found & ~mask
+        return self.elements[mask]
+
+    def subloops(self) -> list:
+        """
+        Enumerate the lattice of subloops from {0} : every subloop found is joined with each element outside it,
+        the closure starting from the subloop. The list is cached until the next update_mul
+        :return: the list of the arrays of the elements of all the subloops, by increasing order
+        """
+        return self._cached("subloops", self._subloops)
+
+    def _subloops(self) -> list:
+        trivial = Subset.from_elements([0], self.order)
+        found = {trivial}
+        worklist = [trivial]
+        while worklist:
+            H = worklist.pop()
+            for x in Subset((1 << self.order) - 1, self.order) - H:
+                K = Subset.from_elements(self.generated_subloop([x], closed=H), self.order)
+                if K not in found:
+                    found.add(K)
+                    worklist.append(K)
+        return sorted((K.elements() for K in found), key=lambda elements: (len(elements), tuple(elements)))
+
+    def normal_subloops(self) -> list:
+        """
+        :return: the list of the arrays of the elements of the normal subloops, by increasing order
+        """
+        return [S for S in self.subloops() if self.is_normal_subloop(S)]
+
+    def associator_failures(self) -> [array, array, array]:
+        """
+        :return: the left, middle and right associator failure counts of the elements, see associator_failures
+        """
+        return self._cached("associator_failures",
+                            lambda: tuple(failures[0] for failures in associator_failures(self.tmul[None, :, :])))
+
+    def nuclei_masks(self) -> [array, array, array]:
+        """
+        :return: the boolean masks of the left, middle and right nuclei
+        """
+        return tuple(failures == 0 for failures in self.associator_failures())
+
     def left_nucleus(self) -> array:
-        elements = []
-        for x in self.elements:
-            for y, z in product(self.elements, repeat=2):
-                if self.mul(x, self.mul(y, z)) != self.mul(self.mul(x, y), z):
-                    break
-            else:
-                elements.append(x)
-        return elements
+        return self.elements[self.nuclei_masks()[0]]
 
     def middle_nucleus(self) -> array:
-        elements = []
-        for y in self.elements:
-            for x, z in product(self.elements, repeat=2):
-                if self.mul(x, self.mul(y, z)) != self.mul(self.mul(x, y), z):
-                    break
-            else:
-                elements.append(y)
-        return elements
+        return self.elements[self.nuclei_masks()[1]]
 
     def right_nucleus(self) -> array:
-        elements = []
-        for z in self.elements:
-            for x, y in product(self.elements, repeat=2):
-                if self.mul(x, self.mul(y, z)) != self.mul(self.mul(x, y), z):
-                    break
-            else:
-                elements.append(z)
-        return elements
+        return self.elements[self.nuclei_masks()[2]]
 
     def nucleus(self) -> array:
-        left = self.left_nucleus()
-        middle = self.middle_nucleus()
-        right = self.right_nucleus()
-        return intersect1d(intersect1d(left, middle), right)
+        left, middle, right = self.nuclei_masks()
+        return self.elements[left & middle & right]
 
     def center(self) -> array:
-        return intersect1d(self.commutant(), self.nucleus())
+        left, middle, right = self.nuclei_masks()
+        return self.elements[left & middle & right & (self.commutant_failures() == 0)]
 
     def left_coset(self, x: int, set_: array) -> array:
         """
         :return: xS where S is a subset of the loop's elements
         """
-        coset = set([])
-        for s in set_:
-            coset.add(self.mul(x, s))
-        return array(list(coset))
+        return Subset.from_elements(self.tmul[x, set_], self.order).elements()
 
     def right_coset(self, x: int, set_: array) -> array:
         """
         :return: Sx where S is a subset of the loop's elements
         """
-        coset = set([])
-        for s in set_:
-            coset.add(self.mul(s, x))
-        return array(list(coset))
+        return Subset.from_elements(self.tmul[set_, x], self.order).elements()
 
     def is_normal_subloop(self, subloop_elements: array) -> bool:
         if not self.is_subloop(subloop_elements):
             return False
 
-        for x in self.elements:
-            xS = self.left_coset(x, subloop_elements)
-            Sx = self.right_coset(x, subloop_elements)
-            if set(xS) != set(Sx):
-                return False
-        return True
+        # all the xS and Sx at once, as bitsets
+        left_cosets = Subset.packed_rows(self.tmul[:, subloop_elements], self.order)
+        right_cosets = Subset.packed_rows(self.tmul[subloop_elements, :].T, self.order)
+        if (left_cosets != right_cosets).any():
+            return False
+
+        # the left cosets must also be the classes of a congruence : the coset of x*y only depends on those of x and y
+        representatives, labels = self._left_coset_labels(subloop_elements)
+        if (labels[self.tmul[:, subloop_elements]] != labels[:, None]).any():
+            return False
+        quotient_table = labels[self.tmul[ix_(representatives, representatives)]]
+        return bool((labels[self.tmul] == quotient_table[ix_(labels, labels)]).all())
+
+    def _left_coset_labels(self, subloop_elements: array) -> [array, array]:
+        """
+        The coset xS is labelled by its smallest element, the labels are then numbered in increasing order
+        :return: the smallest elements of the cosets, in increasing order, and the number of the label of each element
+        """
+        return unique(self.tmul[:, subloop_elements].min(axis=1), return_inverse=True)
 
     def quotient_loop(self, normal_subloop_elements: array) -> [Loop, array]:
         """
-        :return: a loop and the canonical projection
+        :return: a loop and the canonical projection, as the array of the images of the elements
         """
         if not self.is_normal_subloop(normal_subloop_elements):
             raise Exception(f"{normal_subloop_elements} is not a normal subloop")
-        quotient_order = self.order // normal_subloop_elements.shape[0]
-
-        canonical_projection = {}
-
-        elements_left = self.elements
-        quotient_elements = {}
-        elements_quotient = {}
-        rep_to_coset = {}
-        for i in range(quotient_order):
-            rep = min(elements_left)
-            coset = self.left_coset(rep, set_=normal_subloop_elements)
-            elements_left = setdiff1d(elements_left, coset)
-            quotient_elements[i] = rep
-            elements_quotient[rep] = i
-            rep_to_coset[rep] = coset
-            for x in coset:
-                canonical_projection[x] = i
-
-        quotient_table = zeros((quotient_order, quotient_order), dtype=int)
-        for i, j in product(range(quotient_order), repeat=2):
-            x = quotient_elements[i]
-            y = quotient_elements[j]
-            xy = self.mul(x, y)
-            # finding the equivalence class where xy belongs
-            for possible_rep, coset in rep_to_coset.items():
-                if xy in coset:
-                    rep = possible_rep
-                    break
-            else:
-                raise Exception("Unexpected error during the construction of the quotient loop")
-
-            quotient_table[i, j] = elements_quotient[rep]
+        return self._quotient_loop(normal_subloop_elements)
+
+    def _quotient_loop(self, normal_subloop_elements: array) -> [Loop, array]:
+        """
+        quotient_loop without checking that normal_subloop_elements is a normal subloop
+        """
+        representatives, canonical_projection = self._left_coset_labels(normal_subloop_elements)
+        if (canonical_projection[self.tmul[:, normal_subloop_elements]] != canonical_projection[:, None]).any():
+            raise Exception(f"{normal_subloop_elements} is not a normal subloop, its left cosets overlap")
+        quotient_table = canonical_projection[self.tmul[ix_(representatives, representatives)]]
 
         return Loop(quotient_table), canonical_projection
 
     def Z_c_plus_one(self, Z_c):
-        quotient, projection = self.quotient_loop(Z_c)
-        preimage = [x for x in self.elements if projection[x] in quotient.center()]
-        return array(preimage)
+        """
+        :return: the preimage of the center of the quotient by Z_c
+        """
+        if not self.is_normal_subloop(Z_c):
+            raise Exception(f"{Z_c} is not a normal subloop")
+        return self._Z_c_plus_one(Z_c)
+
+    def _Z_c_plus_one(self, Z_c):
+        """
+        Z_c_plus_one without checking that Z_c is a normal subloop
+        """
+        quotient, projection = self._quotient_loop(Z_c)
+        return self.elements[isin(projection, quotient.center())]
+
+    def upper_central_series(self) -> list:
+        """
+        Z_0 = {0} and Z_(c+1) = Z_c_plus_one(Z_c), until Z_c is the whole loop or Z_(c+1) = Z_c.
+        The series is cached until the next update_mul
+        :return: the list of the arrays Z_0, Z_1, ...
+        """
+        return self._cached("upper_central_series", self._upper_central_series)
+
+    def _upper_central_series(self) -> list:
+        series = [array([0])]
+        while series[-1].shape[0] != self.order:
+            Z = self._Z_c_plus_one(series[-1])  # the terms of the series are normal by construction
+            if Z.shape[0] == series[-1].shape[0]:
+                break
+            series.append(Z)
+        return series
 
     def nilpotency_class(self) -> int:
-        Z = array([0])
-        nilpotency = 0
-        while len(set(Z)) != self.order:
-            Z = self.Z_c_plus_one(Z)
-            nilpotency += 1
-            if nilpotency > self.order:
-                raise Exception("This loop is not nilpotent")
-        return nilpotency
+        series = self.upper_central_series()
+        if series[-1].shape[0] != self.order:
+            raise Exception("This loop is not nilpotent")
+        return len(series) - 1
 
     def product(self, A: Loop) -> Loop:
         mapping = {(a, b): i for i, (a, b) in enumerate(product(self.elements, A.elements))}
@@ -264,7 +537,7 @@ class Loop:
         return Loop(GN_table)
 
     def copy(self):
-        return Loop(self.tmul)
+        return Loop(self.tmul.copy())
 
 
 class LoopUtils:
@@ -295,6 +568,114 @@ class LoopUtils:
         LoopUtils.save_arr(fname, A.tmul, shift)
 
 
+class LoopBatch:
+    """
+    API for ld, rd and mul of a batch of loops of the same order, stored in contiguous (batch, n, n) arrays.
+    The invariants are computed for the whole batch at once and are given as boolean masks.
+    The tables are stored in the smallest unsigned dtype able to hold the elements (see loopy.table.code_dtype),
+    and the ld and rd tables are only computed on first use.
+    """
+
+    def __init__(self, mul_tables: array, tld: array = None, trd: array = None):
+        """
+        :param mul_tables: stacked mul_tables of loops represented by 0, ..., n-1, 0 is the identity
+        :param tld: optional stacked ld tables of the loops, computed from mul_tables on first use otherwise
+        :param trd: optional stacked rd tables of the loops, computed from mul_tables on first use otherwise
+        """
+        dtype = code_dtype(mul_tables.shape[-1])
+        self.tmul = ascontiguousarray(mul_tables, dtype=dtype)
+        self.size = self.tmul.shape[0]
+        self.order = self.tmul.shape[1]
+        self.elements = arange(self.order)
+
+        self._tld = None if tld is None else ascontiguousarray(tld, dtype=dtype)
+        self._trd = None if trd is None else ascontiguousarray(trd, dtype=dtype)
+
+    @property
+    def tld(self) -> array:
+        if self._tld is None:
+            self._tld, self._trd = divisions(self.tmul)
+        return self._tld
+
+    @property
+    def trd(self) -> array:
+        if self._trd is None:
+            self._tld, self._trd = divisions(self.tmul)
+        return self._trd
+
+    @staticmethod
+    def from_loops(loops: list) -> LoopBatch:
+        return LoopBatch(stack([A.tmul for A in loops]))
+
+    @staticmethod
+    def from_files(fnames: list, shift=0) -> LoopBatch:
+        return LoopBatch(stack([LoopUtils.table_from_file(fname, shift) for fname in fnames]))
+
+    def _gather(self, table: array, x, y):
+        """
+        :param x: index or array of indexes broadcasting against (batch,)
+        :param y: index or array of indexes broadcasting against (batch,)
+        :return: table[i, x[i], y[i]] for each loop i of the batch
+        """
+        x, y = array(x), array(y)
+        ndim = max(x.ndim, y.ndim, 1)
+        batch = arange(self.size).reshape((-1,) + (1,) * (ndim - 1))
+        return table[batch, x, y]
+
+    def mul(self, x, y):
+        return self._gather(self.tmul, x, y)
+
+    def ld(self, x, y):
+        return self._gather(self.tld, x, y)
+
+    def rd(self, x, y):
+        return self._gather(self.trd, x, y)
+
+    def is_loop(self) -> array:
+        return are_loops(self.tmul)
+
+    def is_associative(self) -> array:
+        associative = ones(self.size, dtype=bool)
+        for b_start, _, block in associator_blocks(self.tmul):
+            associative[b_start:b_start + block.shape[0]] &= block.all(axis=(1, 2, 3))
+        return associative
+
+    def is_commutative(self) -> array:
+        return (self.tmul == self.tmul.transpose(0, 2, 1)).all(axis=(1, 2))
+
+    def is_group(self) -> array:
+        return self.is_loop() & self.is_associative()
+
+    def commutant(self) -> array:
+        return commutant_masks(self.tmul)
+
+    def nucleus(self) -> array:
+        left, middle, right = nuclei_masks(self.tmul)
+        return left & middle & right
+
+    def center(self) -> array:
+        return self.commutant() & self.nucleus()
+
+    def select(self, mask: array) -> LoopBatch:
+        """
+        :param mask: boolean mask (or array of indexes) of the loops to keep
+        :return: the batch of the selected loops, with the ld and rd tables if they are already computed
+        """
+        if self._tld is None:
+            return LoopBatch(self.tmul[mask])
+        return LoopBatch(self.tmul[mask], self._tld[mask], self._trd[mask])
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i: int) -> Loop:
+        return Loop(self.tmul[i].astype(int))
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+
 class GeneralizedLoop(Loop):
     """
         Loops that can be indexed by anything. First element of elements is the identity
@@ -0,0 +1,91 @@
+from glob import glob
+from multiprocessing import Pool, cpu_count
+
+from numpy import array
+
+from loopapy.loop import LoopBatch, LoopUtils, divisions
+from loopy.axiom import Axiom, CompiledAxiom
+
+# axioms of the current worker process, built once by _init_worker
+_worker_axioms = None
+
+
+def _init_worker(axiom_exprs):
+    global _worker_axioms
+    _worker_axioms = [CompiledAxiom(Axiom(expr)) for expr in axiom_exprs]
+
+
+def _screen_tables(ids, tables: array):
+    """
+    :param tables: stacked mul tables of the loops of ids
+    :return: the list of the (loop id, axiom, is_true, counterexample) records of the loops
+    """
+    tlds, trds = divisions(tables)
+    records = []
+    for loop_id, tmul, tld, trd in zip(ids, tables, tlds, trds):
+        for axiom in _worker_axioms:
+            is_true, counterexample = axiom.find_counterexample(tmul, tld, trd)
+            records.append((loop_id, axiom.axiom.base_expr, is_true, counterexample))
+    return records
+
+
+def _screen_files(fnames_and_shift):
+    fnames, shift = fnames_and_shift
+    records = []
+    for fname in fnames:
+        records += _screen_tables([fname], LoopUtils.table_from_file(fname, shift)[None])
+    return records
+
+
+def _screen_batch(ids_and_tables):
+    return _screen_tables(*ids_and_tables)
+
+
+class AxiomScreener:
+    """
+    Check a fixed list of axioms over a collection of loops with a pool of processes.
+    Each worker compiles the axioms once, then receives the loops by chunks.
+    """
+
+    def __init__(self, axiom_exprs, nb_workers: int = None, chunk_size: int = 64):
+        """
+        :param axiom_exprs: list of the strings of the axioms, see loopy.axiom.Axiom
+        :param nb_workers: number of processes, the number of cores by default
+        :param chunk_size: number of loops sent at once to a worker
+        """
+        self.axiom_exprs = list(axiom_exprs)
+        self.nb_workers = cpu_count() if nb_workers is None else nb_workers
+        self.chunk_size = chunk_size
+
+    def screen_files(self, pattern: str, shift=0):
+        """
+        :param pattern: glob of .loop files, as saved by LoopUtils.save_loop
+        :param shift: added to the elements read from the files (see LoopUtils.table_from_file), e.g. -1 for files
+        whose elements are 1, ..., n
+        :return: generator of the (file name, axiom, is_true, counterexample) records, in completion order
+        """
+        fnames = sorted(glob(pattern))
+        chunks = [(fnames[i:i + self.chunk_size], shift) for i in range(0, len(fnames), self.chunk_size)]
+        return self._screen(_screen_files, chunks)
+
+    def screen_batch(self, batch: LoopBatch):
+        """
+        :return: generator of the (index in batch, axiom, is_true, counterexample) records, in completion order
+        """
+        chunks = ((range(i, min(i + self.chunk_size, len(batch))), batch.tmul[i:i + self.chunk_size])
+                  for i in range(0, len(batch), self.chunk_size))
+        return self._screen(_screen_batch, chunks)
+
+    def screen(self, loops, shift=0):
+        """
+        :param loops: glob of .loop files or LoopBatch
+        :param shift: see screen_files, unused for a LoopBatch
+        """
+        if isinstance(loops, LoopBatch):
+            return self.screen_batch(loops)
+        return self.screen_files(loops, shift)
+
+    def _screen(self, fun, chunks):
+        with Pool(self.nb_workers, initializer=_init_worker, initargs=(self.axiom_exprs,)) as pool:
+            for records in pool.imap_unordered(fun, chunks):
+                yield from records
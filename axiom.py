@@ -1,9 +1,12 @@
 from enum import Enum
 from itertools import product
 
+from numpy import arange, argmin, array, broadcast_to, unravel_index, zeros
+
 from loopy.language import Language
 from loopy.parser import Parser
 from loopy.symbol import Variable, SymbolType
+from loopy.dag import TermDAG, TermEvaluator
 from loopy.table import TableMaker
 
 
@@ -71,6 +74,20 @@ class Expr:
 
         return [coordinates[i] for i in self.indexes_of_used_variables]
 
+    def broadcast_shape(self, model, compute_rpn=False):
+        """
+        Suppose self is "Ax Ay Az x*z", its table has only two dimensions. This method gives the shape to reshape
+        it with so that it broadcasts against the instances of all the variables, i.e. (n, 1, n) here
+        :param model: model to use
+        :param compute_rpn: if True, recompute the RPN of self
+        :return: the list of the dimensions, model.cardinal for used variables and 1 for the others
+        """
+        if compute_rpn or self.rpn is None:
+            self.compute_rpn(model)
+            self._compute_indexes_of_used_variables()
+
+        return [model.cardinal if i in self.indexes_of_used_variables else 1 for i in range(len(self.variables))]
+
     def __str__(self):
         return str(self.expr)
 
@@ -125,8 +142,17 @@ class Axiom:
         self.left = Expr(left, self.variables)
         self.right = Expr(right, self.variables)
 
-        self.left_rpn = None
-        self.right_rpn = None
+        # RPNs in self.lang, None if the members use symbols of a model (e.g. its elements), in which case
+        # rpn_error keeps the exception of the parser
+        parser = Parser()
+        self.rpn_error = None
+        try:
+            self.left_rpn = parser.expr_to_rpn_in_language(self.lang, self.left)
+            self.right_rpn = parser.expr_to_rpn_in_language(self.lang, self.right)
+        except Exception as error:
+            self.left_rpn = None
+            self.right_rpn = None
+            self.rpn_error = error
 
         self.ndim = len(self.variables)
 
@@ -134,65 +160,147 @@ class Axiom:
         return self.base_expr
 
 
+def search_counterexample(variables, n, instances_truth, dtype, chunk_size=1 << 16):
+    """
+        Search the first counterexample of an axiom chunk by chunk over the instances of its universal prefix (the
+        leading A variables). The other variables are evaluated on a full index grid and reduced from the innermost
+        quantifier. The first chunks are small and the following ones double in size, since most of the axioms
+        that do not hold fail on the first instances.
+    :param variables: the quantified variables of the axiom, in order
+    :param n: number of elements
+    :param instances_truth: function namespace -> boolean array of the equality of the two members, where namespace
+    maps the variables repr to arrays of indexes, axis 0 being the chunk of prefix instances and the following ones
+    the other variables
+    :param dtype: dtype of the arrays of indexes
+    :param chunk_size: maximum number of instances evaluated at once
+    :return: (is_true, counterexample) where counterexample is None if the axiom holds, otherwise the first
+    falsifying instance of the universal prefix as a dict variable repr -> index
+    """
+    nb_universal = 0
+    while nb_universal < len(variables) and \
+            variables[nb_universal].quantification == SymbolType.UNIVERSAL_QUANTIFIER:
+        nb_universal += 1
+    prefix = variables[:nb_universal]
+    suffix = variables[nb_universal:]
+
+    namespace = {}
+    for i, var in enumerate(suffix):
+        grid_shape = [1] * (1 + len(suffix))
+        grid_shape[1 + i] = n
+        namespace[var.repr] = arange(n, dtype=dtype).reshape(grid_shape)
+
+    max_rows = max(1, chunk_size // n ** len(suffix))
+    rows = 1
+    start = 0
+    while start < n ** nb_universal:
+        stop = min(n ** nb_universal, start + rows)
+        instances = unravel_index(arange(start, stop), [n] * nb_universal) if prefix else ()
+        for var, coordinates in zip(prefix, instances):
+            namespace[var.repr] = coordinates.astype(dtype).reshape([-1] + [1] * len(suffix))
+
+        truth = broadcast_to(instances_truth(namespace), [stop - start] + [n] * len(suffix))
+        for var in reversed(suffix):
+            if var.quantification == SymbolType.UNIVERSAL_QUANTIFIER:
+                truth = truth.all(axis=-1)
+            else:
+                truth = truth.any(axis=-1)
+
+        if not truth.all():
+            i = argmin(truth)
+            return False, {var.repr: int(coordinates[i]) for var, coordinates in zip(prefix, instances)}
+
+        start = stop
+        rows = min(2 * rows, max_rows)
+
+    return True, None
+
+
 class AxiomVerifier:
     def __init__(self, model):
         self.model = model
 
-    def is_true(self, axiom: Axiom, arithmetic_fun=None):
+    def is_true(self, axiom: Axiom, arithmetic_fun=None, streaming=False):
         """
             Verify whether an axiom is True in within self.model. If no arithmetic_fun is given,
             it will calculate the table of the right and left member, so it is better to pre-caclculate the this
             function if is_true is used a large number of time over the same axiom
         :param axiom: the axiom to verify
         :param arithmetic_fun: the lambda_function that will be called with each instance of the variables
+        :param streaming: if True, use find_counterexample instead of the cached tables
         :return: If the axiom is true within self.model
         """
+        if streaming:
+            return self.find_counterexample(axiom)[0]
         if arithmetic_fun is None:
             return self._is_true_no_fun(axiom)
         return self._is_true_fun(axiom, arithmetic_fun)
 
-    def _is_true_no_fun(self, axiom):
-        left = axiom.left
-        right = axiom.right
-
-        cache_manager = self.model.cache_manager
+    def are_true(self, axioms):
+        """
+            Verify several axioms at once with the tables of the right and left members, the subterms they
+            share being computed only once
+        :param axioms: list of Axiom
+        :return: the list of the truth values
+        """
         table_maker = TableMaker(self.model)
-        if not cache_manager.is_cached(left):
-            left_table = table_maker.make_table(left)
-            cache_manager.cache(left, left_table)
+        return [self._is_true_no_fun(axiom, table_maker, cache_sub=True) for axiom in axioms]
 
-        if not cache_manager.is_cached(right):
-            right_table = table_maker.make_table(right)
-            cache_manager.cache(right, right_table)
-
-        left_table = cache_manager.get_table(left)
-        right_table = cache_manager.get_table(right)
-
-        variable_list = axiom.variables
+    def find_counterexample(self, axiom: Axiom, chunk_size=1 << 16):
+        """
+            Verify an axiom chunk by chunk over the instances of its universal prefix (the leading A variables),
+            stopping at the first chunk containing a counterexample, see search_counterexample.
+            Nothing is cached in self.model.cache_manager.
+        :param axiom: the axiom to verify
+        :param chunk_size: maximum number of instances evaluated at once
+        :return: (is_true, counterexample) where counterexample is None if the axiom holds, otherwise the first
+        falsifying instance of the universal prefix as a dict variable repr -> element repr (empty if the
+        axiom doesn't start with an universal quantifier)
+        """
+        parser = Parser()
+        dag = TermDAG()
+        evaluator = TermEvaluator(self.model)
+        left_term = dag.add_rpn(parser.expr_to_rpn(self.model, axiom.left))
+        right_term = dag.add_rpn(parser.expr_to_rpn(self.model, axiom.right))
+
+        def instances_truth(namespace):
+            values = {}  # the subterms shared by the two sides are computed once
+            return self.model.equal_codes(evaluator.evaluate(left_term, namespace, values),
+                                          evaluator.evaluate(right_term, namespace, values))
+
+        is_true, counterexample = search_counterexample(axiom.variables, self.model.cardinal, instances_truth,
+                                                        self.model.mul_table.dtype, chunk_size)
+        if is_true:
+            return True, None
+        return False, {var: str(self.model.elements[i]) for var, i in counterexample.items()}
+
+    def _is_true_no_fun(self, axiom, table_maker=None, cache_sub=False):
+        """
+        :param cache_sub: if True, cache the tables of all the subterms of the two members, otherwise only the tables
+        of the members, unless the cache_manager has a memory budget
+        """
+        left = axiom.left
+        right = axiom.right
 
-        def is_true_aux(variables, partial_instance):
-            if not variables:
-                l_instance = left.coordinates_formatter(partial_instance, self.model)
-                r_instance = right.coordinates_formatter(partial_instance, self.model)
-                # we need the = defined in model because of the special char
-                return self.model.equal(left_table.of(*l_instance), right_table.of(*r_instance))
+        cache_sub = cache_sub or self.model.cache_manager.max_bytes is not None
+        if table_maker is None:
+            table_maker = TableMaker(self.model)
+        left_table = table_maker.make_table(left, check_cache=True, cache_sub=cache_sub, cache_expr=True)
+        right_table = table_maker.make_table(right, check_cache=True, cache_sub=cache_sub, cache_expr=True)
 
-            var = variables[0]
+        # boolean array of all the instances, the i-th axis being the i-th quantified variable
+        truth = self.model.equal_codes(
+            left_table.unpad_codes().reshape(left.broadcast_shape(self.model)),
+            right_table.unpad_codes().reshape(right.broadcast_shape(self.model))
+        )
 
+        # reducing the innermost quantifier first
+        for var in reversed(axiom.variables):
             if var.quantification == SymbolType.UNIVERSAL_QUANTIFIER:
-                is_verified = True
-                for x in self.model.elements:
-                    # Python is lazy so it should avoid unnecessary recursive calls
-                    is_verified = is_verified and is_true_aux(variables[1::], partial_instance + [x])
-
+                truth = truth.all(axis=-1)
             else:
-                is_verified = False
-                for x in self.model.elements:
-                    is_verified = is_verified or is_true_aux(variables[1::], partial_instance + [x])
-
-            return is_verified
+                truth = truth.any(axis=-1)
 
-        return is_true_aux(variable_list, [])
+        return bool(truth)
 
     def _is_true_fun(self, axiom: Axiom, fun):
         variable_list = axiom.variables
@@ -220,6 +328,90 @@ class AxiomVerifier:
         return is_true_aux(variable_list, {})
 
 
+class CompiledAxiom:
+    """
+        Model-independent form of an axiom, built once and applicable to the tables of any loop of any order.
+        The elements are the indexes 0, ..., n-1, 0 being the identity, and the tables are in natural order :
+        mul[x, y] = x*y, ld[x, y] = x\\y and rd[x, y] = x/y (see Model.operation_arrays).
+        The two members are compiled together into a straight-line program, a shared subterm being computed once.
+    """
+    VARIABLE = 0
+    CONSTANT = 1
+    OPERATION = 2
+
+    def __init__(self, axiom: Axiom):
+        self.axiom = axiom
+        lang = axiom.lang
+        operations = {lang.name_to_repr[name]: i for i, name in enumerate(("star", "ld", "rd"))}
+
+        if axiom.left_rpn is None:
+            raise Exception(f"Axiom `{axiom}` can't be parsed in its language: {axiom.rpn_error}") \
+                from axiom.rpn_error
+        dag = TermDAG()
+        self.left = dag.add_rpn(axiom.left_rpn)
+        self.right = dag.add_rpn(axiom.right_rpn)
+
+        # the register of a term is its id, the children come before their parents in dag.terms
+        self.program = []
+        for term in dag.terms:
+            if term.symbol.is_variable:
+                self.program.append((self.VARIABLE, term.symbol.repr))
+            elif not term.is_operation():
+                if term.symbol.repr != lang.identity:
+                    raise Exception(f"Constant `{term.symbol.repr}` can't be compiled, only the identity can")
+                self.program.append((self.CONSTANT, 0))
+            elif term.symbol.repr in operations:
+                arg1, arg2 = term.children
+                self.program.append((self.OPERATION, operations[term.symbol.repr], arg1.id, arg2.id))
+            else:
+                raise Exception(f"Operator `{term.symbol.repr}` can't be compiled")
+
+    def evaluate(self, tables, namespace):
+        """
+        :param tables: (mul, ld, rd)
+        :param namespace: dict variable repr -> array of indexes
+        :return: the arrays of indexes of the left and right members
+        """
+        registers = []
+        for instruction in self.program:
+            if instruction[0] == self.VARIABLE:
+                registers.append(namespace[instruction[1]])
+            elif instruction[0] == self.CONSTANT:
+                registers.append(instruction[1])
+            else:
+                _, op, arg1, arg2 = instruction
+                registers.append(tables[op][registers[arg1], registers[arg2]])
+        return registers[self.left.id], registers[self.right.id]
+
+    def find_counterexample(self, mul, ld, rd, sentinel=None, order=None, chunk_size=1 << 16):
+        """
+            See AxiomVerifier.find_counterexample
+        :param sentinel: if not None, index of the special element, equal to every element
+        :param order: number of elements the variables range over, mul.shape[0] by default
+        :return: (is_true, counterexample) where counterexample is None or a dict variable repr -> index
+        """
+        n = mul.shape[0] if order is None else order
+        tables = (mul, ld, rd)
+
+        def instances_truth(namespace):
+            left, right = self.evaluate(tables, namespace)
+            eq = left == right
+            if sentinel is not None:
+                eq |= (left == sentinel) | (right == sentinel)
+            return eq
+
+        return search_counterexample(self.axiom.variables, n, instances_truth, mul.dtype, chunk_size)
+
+    def is_true(self, mul, ld, rd, sentinel=None, order=None):
+        return self.find_counterexample(mul, ld, rd, sentinel, order)[0]
+
+    def is_true_in(self, model):
+        """
+        :return: the truth value of the axiom in model
+        """
+        return self.is_true(*model.operation_arrays(), sentinel=model.mul_table.sentinel, order=model.cardinal)
+
+
 class TruthValue(Enum):
     FALSE = 0
     TRUE = 1
@@ -228,74 +420,154 @@ class TruthValue(Enum):
 
 class AxiomVerifierSAT:
     def __init__(self, axiom: Axiom, model):
+        """
+            Incremental verification of an axiom in a model whose mul table is partially filled with its
+            special_char : every instance of the axiom is grounded into a Literal, and filling a cell of the table
+            with update_mul only re-examines the literals containing a term that the cell resolves.
+        :param axiom: the axiom to verify
+        :param model: the Model, its mul table must only be changed through self.update_mul
+        """
         self.model = model
         self.axiom = axiom
         self.parser = Parser()
 
-        self.left_rpn = [tok.repr for tok in self.parser.expr_to_rpn(axiom.left, self.model)]
-        self.right_rpn = [tok.repr for tok in self.parser.expr_to_rpn(axiom.right, self.model)]
+        self.left_rpn = [tok.repr for tok in self.parser.expr_to_rpn(self.model, axiom.left)]
+        self.right_rpn = [tok.repr for tok in self.parser.expr_to_rpn(self.model, axiom.right)]
+
+        self.operations = {
+            self.model.lang.name_to_repr["star"]: self.model.mul,
+            self.model.lang.name_to_repr["rd"]: self.model.rdiv,
+            self.model.lang.name_to_repr["ld"]: self.model.ldiv_lexical_order
+        }
 
         self.literals_list = []
 
         self.term_dictionary = TermDictionary()
 
-        var_value_map = {
-            "*": self.model.mul,
-            "/": self.model.rdiv,
-            "\\": self.model.ldiv_lexical_order
-        }
+        # truth value of the i-th instance, in the order of product(elements, repeat=ndim)
+        self.truth = zeros(self.model.cardinal ** self.axiom.ndim, dtype=int)
 
+        var_value_map = {}
         for i, instance in enumerate(product(self.model.elements, repeat=self.axiom.ndim)):
             for var, val in zip(self.axiom.variables, instance):
-                var_value_map[var.repr] = val
+                var_value_map[var.repr] = str(val)
 
-            left = []
-            right = []
-            for tok in self.left_rpn:
-                left.append(var_value_map[tok])
-            for tok in self.right_rpn:
-                right.append(var_value_map[tok])
+            left = [var_value_map.get(tok, tok) for tok in self.left_rpn]
+            right = [var_value_map.get(tok, tok) for tok in self.right_rpn]
 
-            self.literals_list.append(Literal(left, right, id_=i, term_dict=self.term_dictionary))
+            literal = Literal(left, right, id_=i, term_dict=self.term_dictionary, verifier=self)
+            self.literals_list.append(literal)
+            self.truth[i] = literal.update().value
+
+    def value_of(self, term):
+        """
+        :param term: ground term (a, b, op)
+        :return: the repr of a op b, None if the cell is not filled yet
+        """
+        a, b, op = term
+        value = self.operations[op](a, b)
+        if self.model.special_char is not None and value == self.model.special_char:
+            return None
+        return str(value)
+
+    def update_mul(self, x, y, new):
+        """
+            Fill the cell x*y of the mul table of the model with new, and propagate it to the literals
+            (it also fills x \\ new and new / y)
+        """
+        self.model.update_mul(x, y, new)
+        lang = self.model.lang
+        for term in ((x, y, lang.name_to_repr["star"]),
+                     (x, new, lang.name_to_repr["ld"]),
+                     (new, y, lang.name_to_repr["rd"])):
+            for literal in self.term_dictionary.update(term):
+                self.truth[literal.id] = literal.truth_value.value
+
+    def is_true(self) -> TruthValue:
+        """
+            Three-valued truth value of the axiom, reducing the truth values of its instances from the innermost
+            quantifier : an universal quantifier is the minimum and an existential one the maximum for the order
+            FALSE < MAYBE < TRUE
+        """
+        order = array([0, 2, 1])  # rank of FALSE, TRUE and MAYBE
+        truth = order[self.truth].reshape([self.model.cardinal] * self.axiom.ndim)
+        for var in reversed(self.axiom.variables):
+            if var.quantification == SymbolType.UNIVERSAL_QUANTIFIER:
+                truth = truth.min(axis=-1)
+            else:
+                truth = truth.max(axis=-1)
+        return [TruthValue.FALSE, TruthValue.MAYBE, TruthValue.TRUE][int(truth)]
 
 
 class Literal:
-    def __init__(self, left, right, id_: int, term_dict):
+    def __init__(self, left, right, id_: int, term_dict, verifier: AxiomVerifierSAT):
+        """
+        :param left: RPN of the left member, as a list of element and operator reprs
+        :param right: RPN of the right member
+        :param id_: index of the instance
+        :param term_dict: TermDictionary where the literal registers its unresolved ground terms
+        :param verifier: AxiomVerifierSAT giving the values of the ground terms
+        """
         self.left = left
         self.right = right
 
-        self.left_evaluated = False
-        self.right_evaluated = False
-
         self.id = id_
         self.term_dict = term_dict
+        self.verifier = verifier
+
+        self.terms = set()  # ground terms (a, b, op) of which the literal is waiting for the value
+        self.truth_value = TruthValue.MAYBE
 
     def is_true(self) -> TruthValue:
-        if self.left_evaluated and self.right_evaluated:
-            return TruthValue.TRUE if self.left == self.right else TruthValue.FALSE
-        return TruthValue.MAYBE
-
-    def update(self, term, value):
-        n_term = len(term)
-        n_left = len(self.left)
-        n_right = len(self.right)
-
-        i = 0
-        while i <= n_left - n_term:
-            sub_list = self.left[i:(i + n_term)]
-            if self.left[i] == sub_list[0] and sub_list == term:
-                self.left[i:(i + n_term)] = [value]
-                i = 0
-                continue
-            i += 1
+        return self.truth_value
 
-        while i <= n_right - n_term:
-            sub_list = self.right[i:(i + n_term)]
-            if self.right[i] == sub_list[0] and sub_list == term:
-                self.right[i:(i + n_term)] = [value]
-                i = 0
+    def update(self) -> TruthValue:
+        """
+            Replace every ground term whose value is known by its value, then register the literal under the
+            ground terms that remain
+        :return: the new truth value
+        """
+        self.left = self._reduce(self.left)
+        self.right = self._reduce(self.right)
+
+        terms = self._ground_terms(self.left) | self._ground_terms(self.right)
+        for term in self.terms - terms:
+            self.term_dict.remove(term, self)
+        for term in terms - self.terms:
+            self.term_dict.add(term, self)
+        self.terms = terms
+
+        if len(self.left) == 1 and len(self.right) == 1:
+            self.truth_value = TruthValue.TRUE if self.left == self.right else TruthValue.FALSE
+        elif self.left == self.right:
+            self.truth_value = TruthValue.TRUE
+        else:
+            self.truth_value = TruthValue.MAYBE
+        return self.truth_value
+
+    def _reduce(self, rpn):
+        stack = []  # each item is the RPN of an operand, of length 1 if it is known
+        for tok in rpn:
+            if tok not in self.verifier.operations:
+                stack.append([tok])
                 continue
-            i += 1
+            arg2 = stack.pop()
+            arg1 = stack.pop()
+            if len(arg1) == 1 and len(arg2) == 1:
+                value = self.verifier.value_of((arg1[0], arg2[0], tok))
+                if value is not None:
+                    stack.append([value])
+                    continue
+            stack.append(arg1 + arg2 + [tok])
+        return stack.pop()
+
+    def _ground_terms(self, rpn):
+        """
+        :return: the set of the ground terms (a, b, op) of rpn, i.e. the operators applied to two elements
+        """
+        operations = self.verifier.operations
+        return {(rpn[i], rpn[i + 1], rpn[i + 2]) for i in range(len(rpn) - 2)
+                if rpn[i + 2] in operations and rpn[i] not in operations and rpn[i + 1] not in operations}
 
 
 class TermDictionary:
@@ -309,9 +581,17 @@ class TermDictionary:
             self.dict[term] = {literal.id: literal}
 
     def remove(self, term, literal: Literal) -> bool:
+        if term not in self.dict:
+            return False
         return False if self.dict[term].pop(literal.id, None) is None else True
 
-    def update(self, term, value):
-        for literal in self.dict[term]:
-            literal.update(term, value)
-            self.remove(term, literal)
+    def update(self, term):
+        """
+            Re-examine the literals waiting for term, once its value is known
+        :return: the list of the updated literals
+        """
+        literals = list(self.dict.pop(term, {}).values())
+        for literal in literals:
+            literal.terms.discard(term)
+            literal.update()
+        return literals
@@ -1,35 +1,316 @@
+from collections import OrderedDict
+
+from numpy import arange, broadcast_arrays, broadcast_to, concatenate, nonzero, ravel_multi_index, unique, \
+    unravel_index, empty, array, argsort, bincount, cumsum, repeat, searchsorted, zeros
+
+from loopy.table import TableMaker, code_dtype
+
+
 class CacheManager:
-    def __init__(self):
-        self.caches = {}
+    """
+        Tables of terms, keyed on their canonical form (see loopy.dag.Term) : a cached table is shared by all the
+        terms equal up to variable renaming. The axes of a cached table follow the variables of its term
+        in order of first appearance.
 
-    def is_cached(self, expr):
-        return expr.expr in self.caches.keys()
+        If max_bytes is given, the least recently used tables are evicted as soon as the tables in the cache take
+        more than max_bytes bytes. The inverse indexes built by update_cells (see Cache) count in the budget.
+    """
+    def __init__(self, max_bytes=None):
+        """
+        :param max_bytes: memory budget of the cache, None for an unbounded cache
+        """
+        self.max_bytes = max_bytes
+        self.caches = OrderedDict()  # least recently used first
+        self.nbytes = 0
 
-    def cache(self, expr, table):
-        self.caches[expr.expr] = Cache(expr, table)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_cached(self, term):
+        return term.canonical in self.caches.keys()
+
+    def cache(self, term, table):
+        self.delete_cache(term)
+        cache = Cache(term, table)
+        if self.max_bytes is not None and cache.nbytes > self.max_bytes:
+            self.evictions += 1
+            return
+
+        self.caches[term.canonical] = cache
+        self.nbytes += cache.nbytes
+        self._evict()
+
+    def get_table(self, term):
+        if not self.is_cached(term):
+            raise Exception(f"{term} is not cached")
+        self.caches.move_to_end(term.canonical)
+        return self.caches[term.canonical].table
+
+    def lookup(self, term):
+        """
+        Same as get_table, but counting the hits and misses
+        :return: the table of term if cached, None otherwise
+        """
+        if not self.is_cached(term):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.get_table(term)
 
-    def get_table(self, expr):
-        if not self.is_cached(expr):
-            raise Exception(f"{expr} is not cached")
-        return self.caches[expr.expr].table
+    def delete_cache(self, term):
+        if self.is_cached(term):
+            self.nbytes -= self.caches.pop(term.canonical).nbytes
 
-    def delete_cache(self, expr):
-        if self.is_cached(expr):
-            del(self.caches[expr.expr])
+    def clear(self):
+        self.caches.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.caches),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def update_cells(self, model, cells):
+        """
+            Update the cached tables after some cells of the operation tables of model changed. Only the entries
+            that read a changed cell, directly or through a cached subterm whose entries changed, are recomputed.
+            This needs the subterms of the cached terms to be cached too (see cache_sub in TableMaker.make_table),
+            the tables of the terms having a subterm not cached are recomputed entirely.
+            The entries reading a changed cell are found with the inverse indexes of the tables of the subterms, so
+            an update costs about the number of entries read instead of the size of the tables.
+        :param model: the Model whose tables changed
+        :param cells: dict operator repr -> (a, b) where a, b are the indexes of the cell of a*b, a\\b or a/b that
+        changed
+        """
+        changed = {}  # canonical form -> flat indexes of the entries whose value changed, None if unknown
+        for cache in sorted(self.caches.values(), key=lambda c: c.term.size):
+            term = cache.term
+            codes = cache.table.unpad_codes()  # a view, updated in place
+
+            positions = self._positions_to_update(model, term, cells, changed) if term.variables else None
+            if positions is None:
+                self.cache(term, TableMaker(model).make_term_table(term))
+                changed[term.canonical] = None
+                continue
+
+            coordinates = unravel_index(positions, codes.shape)
+            arg1, arg2 = [self._values_at(model, child, term, coordinates) for child in term.children]
+            values = model.array_binary_operations[term.symbol.repr](arg1, arg2)
+            old_values = codes[coordinates]
+            differ = values != old_values
+            codes[coordinates] = values
+            changed[term.canonical] = positions[differ]
+            cache.record_changes(changed[term.canonical], old_values[differ])
+        self._evict()
+
+    def _positions_to_update(self, model, term, cells, changed):
+        """
+        :return: the flat indexes of the entries of the table of term reading a changed cell or a changed entry of
+        one of its subterms, None if it can't be known
+        """
+        n = model.cardinal
+        parts = [empty(0, dtype=int)]
+        for child in term.children:
+            if not child.is_operation():
+                continue
+            if changed.get(child.canonical) is None or not self.is_cached(child):
+                return None
+            child_positions = changed[child.canonical]
+            if child_positions.size:
+                if not child.variables:
+                    return arange(n ** len(term.variables))
+                child_coordinates = unravel_index(child_positions, [n] * len(child.variables))
+                parts.append(self._expand(term, child.variables, child_coordinates, n))
+
+        if term.symbol.repr in cells:
+            parts.append(self._reading(model, term, *cells[term.symbol.repr]))
+
+        return unique(concatenate(parts))
+
+    def _reading(self, model, term, a, b):
+        """
+        If a child has all the variables of term, its entries equal to its value are read from its inverse index and
+        filtered on the value of the other child. Otherwise the entries equal to a in the table of the first child and
+        to b in the table of the second one are read from the inverse indexes, then joined on the variables the
+        children share
+        :return: the flat indexes of the entries of the table of term reading the cell (a, b) of its operation
+        """
+        n = model.cardinal
+        k = len(term.variables)
+        for child, value, other, other_value in zip(term.children, (a, b), term.children[::-1], (b, a)):
+            if child.is_operation() and len(child.variables) == k:
+                coordinates = unravel_index(self._positions_of(child, value), [n] * k)
+                positions = self._expand(term, child.variables, coordinates, n)
+                other_values = self._values_at(model, other, term, unravel_index(positions, [n] * k))
+                return positions[broadcast_to(other_values == other_value, positions.shape)]
+
+        matches = []  # per child, its variables and the coordinates of the entries of its table equal to its value
+        for child, value in zip(term.children, (a, b)):
+            if child.symbol.is_variable:
+                if value >= n:  # the sentinel
+                    return empty(0, dtype=int)
+                matches.append((child.variables, (array([value]),)))
+            elif not child.variables:
+                if model.mul_table.index_of(child.symbol.repr) != value:
+                    return empty(0, dtype=int)
+                matches.append(((), ()))
+            else:
+                positions = self._positions_of(child, value)
+                matches.append((child.variables, unravel_index(positions, [n] * len(child.variables))))
+
+        (variables1, coordinates1), (variables2, coordinates2) = matches
+        shared = [v for v in variables1 if v in variables2]
+        key1 = self._key(variables1, coordinates1, shared, n)
+        key2 = self._key(variables2, coordinates2, shared, n)
+
+        # pairs (i1, i2) of entries with the same shared coordinates
+        order2 = argsort(key2, kind="stable")
+        starts = searchsorted(key2[order2], key1, side="left")
+        counts = searchsorted(key2[order2], key1, side="right") - starts
+        i1 = repeat(arange(key1.size), counts)
+        i2 = order2[arange(i1.size) - repeat(cumsum(counts) - counts, counts) + repeat(starts, counts)]
+
+        variables = variables1 + tuple(v for v in variables2 if v not in variables1)
+        coordinates = tuple(c[i1] for c in coordinates1) + \
+            tuple(c[i2] for v, c in zip(variables2, coordinates2) if v not in variables1)
+        return self._expand(term, variables, coordinates, n)
+
+    @staticmethod
+    def _key(variables, coordinates, shared, n):
+        """
+        :return: the flat indexes of the coordinates of the shared variables, one per entry of coordinates
+        """
+        size = coordinates[0].size if coordinates else 1
+        if not shared:
+            return zeros(size, dtype=int)
+        return ravel_multi_index([coordinates[variables.index(v)] for v in shared], [n] * len(shared))
+
+    def _positions_of(self, term, value):
+        """
+        :return: the flat indexes of the entries of the cached table of term equal to value
+        """
+        cache = self.caches[term.canonical]
+        nbytes = cache.nbytes
+        positions = cache.positions_of(value)
+        self.nbytes += cache.nbytes - nbytes  # the inverse index may have just been built
+        return positions
+
+    def _values_at(self, model, child, term, coordinates):
+        """
+        :param coordinates: tuple of arrays of coordinates in the table of term
+        :return: the values of child, a subterm of term, at these coordinates
+        """
+        child_coordinates = tuple(coordinates[term.variables.index(v)] for v in child.variables)
+        if child.symbol.is_variable:
+            return child_coordinates[0]
+        if not child.is_operation():
+            return model.mul_table.index_of(child.symbol.repr)
+        return self.caches[child.canonical].table.unpad_codes()[child_coordinates]
+
+    @staticmethod
+    def _expand(term, variables, coordinates, n):
+        """
+        :param variables: tuple of some of the variables of term
+        :param coordinates: tuple of arrays of coordinates, one per variable of variables
+        :return: the flat indexes of the entries of the table of term having these coordinates, whatever the
+        other variables are
+        """
+        free = [v for v in term.variables if v not in variables]
+        full_coordinates = []
+        for v in term.variables:
+            if v in variables:
+                full_coordinates.append(coordinates[variables.index(v)].reshape([-1] + [1] * len(free)))
+            else:
+                grid_shape = [1] * (1 + len(free))
+                grid_shape[1 + free.index(v)] = n
+                full_coordinates.append(arange(n).reshape(grid_shape))
+        return ravel_multi_index(broadcast_arrays(*full_coordinates), [n] * len(term.variables)).ravel()
+
+    def _evict(self):
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            _, cache = self.caches.popitem(last=False)
+            self.nbytes -= cache.nbytes
+            self.evictions += 1
 
 
 class Cache:
     """
-        Given an expression, a cache allows to access directly the computed element of the expression
-        without recalculating elements
+        Given a term, a cache allows to access directly the computed element of the term
+        without recalculating elements.
+
+        The inverse index of the table (one bucket of positions per value) is built on the first call to positions_of.
+        The changed positions are then appended to the bucket of their new value, and the positions that left a bucket
+        are only dropped when this bucket is read again, so that the index costs about the number of changed entries.
     """
-    def __init__(self, expr_, table):
+    def __init__(self, term, table):
         """
-        :param expr_: Expr expression to cache
-        :param table: table that computes the expression
+        :param term: Term to cache
+        :param table: table that computes the term
         """
-        self.expr = expr_
+        self.term = term
         self.table = table
 
+        self.buckets = None  # value -> flat indexes of the entries of the table (possibly stale) having this value
+        self.pending = None  # value -> list of flat indexes of the entries that changed to this value
+        self.dirty = None  # boolean mask of the values whose bucket may hold entries that changed
+        self.nb_changes = 0
+        self.index_nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self.table.table.nbytes + self.index_nbytes
+
+    def positions_of(self, value):
+        """
+        :return: the flat indexes of the entries of the (unpadded) table equal to value, possibly repeated
+        """
+        if self.buckets is None:
+            self._build_index()
+        if self.dirty[value] or self.pending[value]:
+            codes = self.table.unpad_codes()
+            positions = concatenate([self.buckets[value]] + self.pending[value])
+            self.buckets[value] = positions[codes[unravel_index(positions, codes.shape)] == value]
+            self.pending[value] = []
+            self.dirty[value] = False
+        return self.buckets[value].astype(int)
+
+    def record_changes(self, positions, old_values):
+        """
+        :param positions: flat indexes of the entries of the (unpadded) table whose value changed
+        :param old_values: their values before the change
+        """
+        if self.buckets is None or not positions.size:
+            return
+        codes = self.table.unpad_codes()
+        self.nb_changes += positions.size
+        if self.nb_changes > codes.size:  # too many stale positions kept
+            self._build_index()
+            return
+
+        self.dirty[old_values] = True
+        values = codes[unravel_index(positions, codes.shape)]
+        counts = bincount(values, minlength=len(self.buckets))
+        ends = cumsum(counts)
+        positions = positions[argsort(values, kind="stable")].astype(self.buckets[0].dtype)
+        for value in nonzero(counts)[0]:
+            self.pending[value].append(positions[ends[value] - counts[value]:ends[value]])
+
+    def _build_index(self):
+        codes = self.table.unpad_codes()
+        order = argsort(codes, axis=None, kind="stable").astype(code_dtype(codes.size))
+        counts = bincount(codes.ravel(), minlength=len(self.table.elements))
+        ends = cumsum(counts)
+        self.buckets = [order[end - count:end] for count, end in zip(counts, ends)]
+        self.pending = [[] for _ in self.buckets]
+        self.dirty = zeros(len(self.buckets), dtype=bool)
+        self.nb_changes = 0
+        self.index_nbytes = order.nbytes
+
     def update(self, x, y, z):
         self.table.update(x, y, z)
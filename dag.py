@@ -0,0 +1,160 @@
+from numpy import arange, asarray
+
+from loopy.symbol import SymbolType
+
+
+class Term:
+    """
+        Node of a TermDAG : a variable, a constant, or an operator applied to two terms
+    """
+    def __init__(self, id_, symbol, children=()):
+        """
+        :param id_: index of the term in its TermDAG
+        :param symbol: Symbol of the variable, the constant or the operator
+        :param children: tuple of the two Term operands if symbol is an operator
+        """
+        self.id = id_
+        self.symbol = symbol
+        self.children = children
+
+        # variables in order of first appearance, they are the axes of the table of the term
+        if self.symbol.is_variable:
+            self.variables = (self.symbol.repr,)
+        else:
+            variables = []
+            for child in self.children:
+                variables += [v for v in child.variables if v not in variables]
+            self.variables = tuple(variables)
+
+        self.size = 1 + sum(child.size for child in self.children)
+
+        # e.g. "(y*(x*y))" and "(a*(b*a))" have the same canonical form "(#0*(#1*#0))"
+        self.canonical = self.render({v: f"#{i}" for i, v in enumerate(self.variables)})
+
+    def is_operation(self):
+        return self.symbol.type == SymbolType.OPERATOR
+
+    def render(self, names=None):
+        """
+        :param names: dict variable repr -> name to use for it
+        :return: the fully parenthesized string of the term
+        """
+        if names is None:
+            names = {}
+        if not self.is_operation():
+            return names.get(self.symbol.repr, self.symbol.repr)
+        left, right = self.children
+        return f"({left.render(names)}{self.symbol.repr}{right.render(names)})"
+
+    def __str__(self):
+        return self.render()
+
+    def __repr__(self):
+        return str(self)
+
+
+class TermDAG:
+    """
+        Hash-consed DAG of terms : a subterm appearing several times, in one or in several expressions,
+        is represented by a unique Term
+    """
+    def __init__(self):
+        self.terms = []  # children always come before their parents
+        self.key_to_term = {}
+
+    def add_rpn(self, rpn):
+        """
+        :param rpn: RPN of an expression, as given by Parser.expr_to_rpn
+        :return: the Term of the expression
+        """
+        stack = []
+        for token in rpn:
+            if token.type == SymbolType.OPERATOR:
+                arg2 = stack.pop()
+                arg1 = stack.pop()
+                stack.append(self.term(token, (arg1, arg2)))
+            else:
+                stack.append(self.term(token))
+        return stack.pop()
+
+    def term(self, symbol, children=()):
+        key = (symbol.repr, symbol.is_variable) + tuple(child.id for child in children)
+        if key not in self.key_to_term:
+            term = Term(len(self.terms), symbol, children)
+            self.terms.append(term)
+            self.key_to_term[key] = term
+        return self.key_to_term[key]
+
+    def __len__(self):
+        return len(self.terms)
+
+
+def place(table, source, target):
+    """
+    :param table: array with one axis per variable of source
+    :param source: tuple of variables repr
+    :param target: tuple of variables repr, containing source
+    :return: view of table with one axis per variable of target, of size 1 for those not in source
+    """
+    order = sorted(range(len(source)), key=lambda i: target.index(source[i]))
+    placed = table.transpose(order)
+    sizes = iter(placed.shape)
+    return placed.reshape([next(sizes) if v in source else 1 for v in target])
+
+
+class TermEvaluator:
+    def __init__(self, model, tables=None):
+        """
+            Evaluate the terms of a TermDAG in model, with the integer-coded tables of the model.
+            Every distinct term, up to variable renaming, is computed once : its table is stored in self.tables
+            under its canonical form. The tables must not be reused once the model has changed.
+        :param model: the Model
+        :param tables: optional dict canonical form -> table to start with
+        """
+        self.model = model
+        self.tables = {} if tables is None else tables
+
+    def canonical_table(self, term: Term):
+        """
+        :return: the table of term, with one axis per variable of term.variables
+        """
+        if term.canonical not in self.tables:
+            self.tables[term.canonical] = self._compute(term)
+        return self.tables[term.canonical]
+
+    def table_on(self, term: Term, variables):
+        """
+        :param variables: tuple of variables repr, containing term.variables
+        :return: view of the table of term with one axis per variable of variables (size 1 for unused ones)
+        """
+        return place(self.canonical_table(term), term.variables, variables)
+
+    def _compute(self, term: Term):
+        dtype = self.model.mul_table.dtype
+        if term.symbol.is_variable:
+            return arange(self.model.cardinal, dtype=dtype)
+        if not term.is_operation():
+            return asarray(self.model.mul_table.index_of(term.symbol.repr), dtype=dtype)
+
+        arg1, arg2 = [self.table_on(child, term.variables) for child in term.children]
+        return asarray(self.model.array_binary_operations[term.symbol.repr](arg1, arg2))
+
+    def evaluate(self, term: Term, namespace, values=None):
+        """
+            Evaluate term on the arrays of indexes given in namespace, each operator being one gather into the
+            integer-coded tables and each term of the DAG being computed once
+        :param namespace: dict variable repr -> array of indexes
+        :param values: dict term id -> value, shared between the calls on the same namespace
+        :return: the array of indexes of term
+        """
+        if values is None:
+            values = {}
+        if term.id not in values:
+            if term.symbol.is_variable:
+                values[term.id] = namespace[term.symbol.repr]
+            elif not term.is_operation():
+                values[term.id] = self.model.mul_table.index_of(term.symbol.repr)
+            else:
+                arg1, arg2 = [self.evaluate(child, namespace, values) for child in term.children]
+                values[term.id] = self.model.array_binary_operations[term.symbol.repr](arg1, arg2)
+        return values[term.id]
@@ -1,4 +1,5 @@
 import warnings
+from hashlib import blake2b
 from loopy.symbol import Symbol, SymbolType
 
 
@@ -27,6 +28,9 @@ class Language:
         self.name_to_symbol = {s.name: s for s in self.symbols}
         self.name_to_repr = {s.name: s.repr for s in self.symbols}
 
+        self._trie = None  # built on demand by trie()
+        self._fingerprint = None  # built on demand by fingerprint()
+
     def add_symbol(self, symbol_repr, symbol_type, name):
         """
             Typically, call when constructing a new loop table with the symbol from 1 to n-1
@@ -45,6 +49,27 @@ class Language:
         self.name_to_symbol[name] = symb
         self.name_to_repr[name] = symb.repr
 
+        self._trie = None
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """
+        :return: digest of the symbols of the language, equal for two languages parsing the same way. It is computed
+        once until a symbol is added, and is cheap to hash (bytes cache their hash)
+        """
+        if self._fingerprint is None:
+            description = "\0".join(f"{s.repr}\1{s.type.value}\1{s.name}" for s in self.symbols)
+            self._fingerprint = blake2b(description.encode(), digest_size=16).digest()
+        return self._fingerprint
+
+    def trie(self):
+        """
+        :return: the SymbolTrie of the symbols of the language, built once until a symbol is added
+        """
+        if self._trie is None:
+            self._trie = SymbolTrie(self.symbols)
+        return self._trie
+
     def is_quantifier(self, symbol_repr):
         if symbol_repr not in self.repr_to_symbol.keys():
             return False
@@ -70,3 +95,37 @@ class Language:
 
     def list_of_repr(self):
         return [s.repr for s in self.symbols]
+
+
+class SymbolTrie:
+    """
+        Prefix tree of symbol representations, to find the longest symbol starting at a position of a string in
+        a time independent of the number of symbols
+    """
+    END = None  # key of the symbol ending at a node
+
+    def __init__(self, symbols=()):
+        self.root = {}
+        for symbol in symbols:
+            self.add(symbol)
+
+    def add(self, symbol):
+        node = self.root
+        for c in symbol.repr:
+            node = node.setdefault(c, {})
+        node[self.END] = symbol
+
+    def longest_match(self, text, start):
+        """
+        :return: (symbol, length) of the longest symbol whose representation starts at text[start],
+        (None, 0) if there is none
+        """
+        node = self.root
+        match = None, 0
+        i = start
+        while i < len(text) and text[i] in node:
+            node = node[text[i]]
+            i += 1
+            if self.END in node:
+                match = node[self.END], i - start
+        return match
@@ -1,4 +1,4 @@
-from numpy import ndarray, size, empty
+from numpy import ndarray, size, full, indices, ones
 
 from loopy.axiom import Axiom, AxiomVerifier
 from loopy.cache import CacheManager
@@ -9,10 +9,11 @@ from loopy.table import Table, TableMaker
 
 
 class Model:
-    def __init__(self, mul_table: ndarray, identity='0', special_char=None):
+    def __init__(self, mul_table: ndarray, identity='0', special_char=None, cache_max_bytes=None):
         """
         :param mul_table: multiplication table of the loop
         :param identity: identity element of the loop
+        :param cache_max_bytes: memory budget of the cache_manager, None for an unbounded cache
         """
         self.identity_repr = identity
         self.lang = Language(identity=self.identity_repr)
@@ -43,11 +44,18 @@ class Model:
 
         self.arithmetic_function_generator = ArithmeticFunctionGenerator(self.lambda_binary_operations)
 
+        # same operations, but as gathers into the integer-coded tables : a and b are arrays of indexes
+        self.array_binary_operations = {
+            self.lang.name_to_repr["star"]: lambda a, b: self.mul_table.table[a, b],
+            self.lang.name_to_repr["ld"]: lambda a, b: self.ldiv_table.table[b, a],
+            self.lang.name_to_repr["rd"]: lambda a, b: self.rdiv_table.table[a, b],
+        }
+
         for elt in self.elements:
             if elt != self.identity_repr:
                 self.lang.add_symbol(elt, SymbolType.OPERAND, elt)
 
-        self.cache_manager = CacheManager()
+        self.cache_manager = CacheManager(cache_max_bytes)
 
     def equal(self, x, y):
         """
@@ -59,6 +67,19 @@ class Model:
             return True
         return x == y
 
+    def equal_codes(self, x, y):
+        """
+        Vectorized version of equal
+        :param x: array of indexes of elements
+        :param y: array of indexes of elements
+        :return: the boolean array of x == y
+        """
+        eq = x == y
+        if self.special_char is not None:
+            sentinel = self.mul_table.sentinel
+            eq |= (x == sentinel) | (y == sentinel)
+        return eq
+
     def change_tables(self, mul_table, ldiv_table, rdiv_table):
         self.mul_table = mul_table
         self.ldiv_table = ldiv_table
@@ -80,26 +101,52 @@ class Model:
     def rdiv(self, x, y):
         return self.rdiv_table.of(x, y)
 
+    def operation_arrays(self):
+        """
+        :return: the integer-coded tables (mul, ld, rd) in natural order, i.e. ld[x, y] = x \\ y, as used by
+        CompiledAxiom. They are padded with the sentinel if there is a special_char
+        """
+        return self.mul_table.table, self.ldiv_table.table.T, self.rdiv_table.table
+
     def update_mul(self, x, y, new, update_cache=False):
         self.mul_table.update(x, y, new=new)
         self.ldiv_table.update(new, x, new=y)
         self.rdiv_table.update(new, y, new=x)
         if update_cache:
-            self.update_cache()
+            x, y, new = [self.mul_table.index_of(e) for e in (x, y, new)]
+            self.cache_manager.update_cells(self, {
+                self.lang.name_to_repr["star"]: (x, y),  # x * y = new
+                self.lang.name_to_repr["ld"]: (x, new),  # x \ new = y
+                self.lang.name_to_repr["rd"]: (new, y),  # new / y = x
+            })
 
     def update_cache(self):
         """
         Recalculate the whole cache, so can be very expensive
         """
         table_maker = TableMaker(self)
-        for cache in self.cache_manager.caches.values():
-            expr = cache.expr
-            new_table = table_maker.make_table(expr)
-            self.cache_manager.cache(expr, new_table)
+        for cache in list(self.cache_manager.caches.values()):
+            self.cache_manager.cache(cache.term, table_maker.make_term_table(cache.term))
+
+    def truth_value(self, axiom: Axiom, arithmetic_fun=None, streaming=False):
+        av = AxiomVerifier(self)
+        return av.is_true(axiom, arithmetic_fun, streaming)
+
+    def truth_values(self, axioms):
+        """
+        :param axioms: list of Axiom
+        :return: the list of their truth values, computing once the subterms they share
+        """
+        av = AxiomVerifier(self)
+        return av.are_true(axioms)
 
-    def truth_value(self, axiom: Axiom, arithmetic_fun=None):
+    def find_counterexample(self, axiom: Axiom, chunk_size=1 << 16):
+        """
+        See AxiomVerifier.find_counterexample
+        :return: (is_true, counterexample)
+        """
         av = AxiomVerifier(self)
-        return av.is_true(axiom, arithmetic_fun)
+        return av.find_counterexample(axiom, chunk_size)
 
     def axiom_to_function(self, axiom: Axiom):
         """
@@ -119,32 +166,41 @@ class Model:
         return lambda **kwargs: self.equal(left_fun(**kwargs), right_fun(**kwargs))
 
     def _make_ldiv_table(self):
+        """
+        y \\ (y*z) = z, so the row y of the ldiv table is the inverse permutation of the row y of the mul table
+        """
         ldiv_table = self.empty_operation_table()
-        for y in self.elements:
-            for x in self.elements:
-                for z in self.elements:
-                    if x == self.mul_table.of(y, z):
-                        ldiv_table.update(x, y, new=z)
+        y, z, yz = self._known_products()
+        ldiv_table.unpad_codes()[yz, y] = z
         return ldiv_table
 
     def _make_rdiv_table(self):
+        """
+        (z*y) / y = z, so the column y of the rdiv table is the inverse permutation of the column y of the mul table
+        """
         rdiv_table = self.empty_operation_table()
-        for y in self.elements:
-            for x in self.elements:
-                for z in self.elements:
-                    if x == self.mul_table.of(z, y):
-                        rdiv_table.update(x, y, new=z)
+        z, y, zy = self._known_products()
+        rdiv_table.unpad_codes()[zy, y] = z
         return rdiv_table
 
+    def _known_products(self):
+        """
+        :return: the arrays of indexes x, y and x*y for all the products of the mul table other than special_char,
+        in lexicographic order of (x, y)
+        """
+        codes = self.mul_table.unpad_codes()
+        x, y = indices(codes.shape)
+        known = codes != self.mul_table.sentinel if self.special_char is not None else ones(codes.shape, dtype=bool)
+        return x[known], y[known], codes[known]
+
     def empty_operation_table(self):
         """
         An empty table for mul, rd or ld is filled with the special_char if one, otherwise with the identity.
         :return: a Table() that has to be completely filled if no special char
         """
-        table = empty((self.cardinal, self.cardinal), dtype='int8').astype('str')
         filling_char = self.special_char if self.special_char is not None else self.identity_repr
-        table[:, :] = filling_char
-        return Table(table, self.elements, ndim=2, special_char=self.special_char)
+        table = full((self.cardinal, self.cardinal), self.mul_table.index_of(filling_char))
+        return Table(table, self.elements, ndim=2, special_char=self.special_char, encoded=True)
 
     def __str__(self):
         return str(self.mul_table)
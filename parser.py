@@ -1,10 +1,52 @@
+from collections import OrderedDict
+
+from loopy.language import SymbolTrie
 from loopy.symbol import SymbolType
 
 
+class ParseCache:
+    """
+        LRU cache of the RPNs of the parsed expressions, keyed on the expression, its variables and the fingerprint
+        of the language
+    """
+    def __init__(self, max_size=1 << 12):
+        self.max_size = max_size
+        self.rpns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(lang, expr, variables):
+        return str(expr), tuple((v.repr, v.quantification.value) for v in variables), lang.fingerprint()
+
+    def get(self, key):
+        rpn = self.rpns.get(key)
+        if rpn is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.rpns.move_to_end(key)
+        return rpn
+
+    def put(self, key, rpn):
+        self.rpns[key] = rpn
+        self.rpns.move_to_end(key)
+        while len(self.rpns) > self.max_size:
+            self.rpns.popitem(last=False)
+
+    def clear(self):
+        self.rpns.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 class Parser:
     """
         Tools for parsing expressions
     """
+    # shared by all the parsers of the process
+    parse_cache = ParseCache()
+
     def __init__(self):
         pass
 
@@ -12,38 +54,39 @@ class Parser:
     def tokenize(model, expr, variables=None):
         """
             tokenize self.expr with tokens from self.variables and the language. Careful, it prioritize the longest
-            token, e.g. if x*y is a variable name, then it will be tokenized as ["x*y"] and not ["x", "*", "y"]
+            token, e.g. if x*y is a variable name, then it will be tokenized as ["x*y"] and not ["x", "*", "y"].
+            A variable wins over a symbol of the language with the same representation
         :return: the tuple of the tokenized symbols
         """
+        return Parser.tokenize_in_language(model.lang, expr, variables)
+
+    @staticmethod
+    def tokenize_in_language(lang, expr, variables=None):
+        """
+            Same as tokenize, with the symbols of lang instead of those of a model
+        """
         if variables is None:
             variables = expr.variables
 
-        lang = model.lang
-        tokens_symbols = tuple(lang.symbols) + variables
-
-        max_token_len = max([len(symbol.repr) for symbol in tokens_symbols])
+        lang_trie = lang.trie()
+        variables_trie = SymbolTrie(variables)
 
         tokenized = []
         i = 0
         len_expr = len(expr)
 
         while i < len_expr:
-            tok_symbol = None
-            temp_tok = ''
-            tok_len = 0
-            for j in range(1, 1 + max_token_len):
-                temp_tok = expr[i:i+j]
-                for symbol in tokens_symbols:
-                    if temp_tok in symbol.repr:
-                        tok_symbol = symbol
-                        tok_len = j
+            tok_symbol, tok_len = lang_trie.longest_match(expr, i)
+            var_symbol, var_len = variables_trie.longest_match(expr, i)
+            if var_symbol is not None and var_len >= tok_len:  # variables shadow the symbols of the language
+                tok_symbol, tok_len = var_symbol, var_len
             if tok_symbol is None:
-                raise Exception(f"Could not tokenize properly `{expr}`. Unknown token in `{temp_tok}`")
+                raise Exception(f"Could not tokenize properly `{expr}`. Unknown token at `{expr[i:]}`")
 
             tokenized.append(tok_symbol)
             i += tok_len
 
-        return tuple(tok for tok in tokenized)
+        return tuple(tokenized)
 
     @staticmethod
     def tokenized_to_rpn(tokenized_symbol):
@@ -79,11 +122,25 @@ class Parser:
 
     def expr_to_rpn(self, model, expr, variables=None):
         """
-            Transforms an expression to its symbolic RPN
+            Transforms an expression to its symbolic RPN, looked up in Parser.parse_cache first
             :return a tuple of Symbol
         """
-        tok = self.tokenize(model, expr, variables)
-        return self.tokenized_to_rpn(tok)
+        return self.expr_to_rpn_in_language(model.lang, expr, variables)
+
+    def expr_to_rpn_in_language(self, lang, expr, variables=None):
+        """
+            Same as expr_to_rpn, with the symbols of lang instead of those of a model
+        """
+        if variables is None:
+            variables = expr.variables
+
+        key = self.parse_cache.key(lang, expr, variables)
+        rpn = self.parse_cache.get(key)
+        if rpn is None:
+            tok = self.tokenize_in_language(lang, expr, variables)
+            rpn = self.tokenized_to_rpn(tok)
+            self.parse_cache.put(key, rpn)
+        return rpn
 
     def rpn_unfold(self, rpn):
         pass
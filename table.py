@@ -1,27 +1,68 @@
-from warnings import warn
-from itertools import product
-from numpy import copy, empty, pad, append
+from numpy import copy, pad, append, array, unique, broadcast_to, uint8, uint16, uint32
+from loopy.dag import TermDAG, TermEvaluator
 from loopy.parser import Parser
 
 
+def code_dtype(nb_codes):
+    """
+    :param nb_codes: number of distinct codes to store (elements and sentinel included)
+    :return: the smallest unsigned integer dtype able to index nb_codes elements
+    """
+    if nb_codes <= 1 << 8:
+        return uint8
+    if nb_codes <= 1 << 16:
+        return uint16
+    return uint32
+
+
 class Table:
-    def __init__(self, table_, elements, ndim, special_char=None):
-        self.table = table_.astype('str')
+    def __init__(self, table_, elements, ndim, special_char=None, encoded=False):
+        """
+        The table is stored integer-coded : each element is replaced by its index in self.elements, string
+        representations are only used at the API boundary (of, at, update, __str__).
+        :param table_: array of the elements representations, or of their indexes if encoded
+        :param elements: array of the elements representations
+        :param ndim: dimension of the table
+        :param special_char: if not None, the table is padded with the index of special_char (the sentinel)
+        :param encoded: if True, table_ already contains indexes into elements
+        """
         self.elements = elements.astype('str')
         self.ndim = ndim
 
         self.has_been_padded = False
         self.special_char = special_char
-        if self.special_char is not None:
-            self.table = pad(self.table, (0, 1), constant_values=self.special_char)
-            if self.special_char not in elements:
-                self.elements = append(self.elements, self.special_char)
-            self.has_been_padded = True
+        if self.special_char is not None and self.special_char not in self.elements:
+            self.elements = append(self.elements, self.special_char)
 
         self.element_to_index = {}  # optimisation
         for i, x in enumerate(self.elements):
             self.element_to_index[x] = i
 
+        self.dtype = code_dtype(len(self.elements))
+        self.sentinel = None if self.special_char is None else self.index_of(self.special_char)
+
+        self.table = table_.astype(self.dtype) if encoded else self.encode(table_)
+        if self.special_char is not None:
+            self.table = pad(self.table, (0, 1), constant_values=self.sentinel)
+            self.has_been_padded = True
+
+    def encode(self, values):
+        """
+        :param values: array of elements representations
+        :return: the array of their indexes, with a dictionary lookup per distinct value only
+        """
+        values = array(values).astype('str')
+        distinct, inverse = unique(values, return_inverse=True)
+        codes = array([self.index_of(x) for x in distinct], dtype=self.dtype)
+        return codes[inverse].reshape(values.shape)
+
+    def decode(self, codes):
+        """
+        :param codes: array of indexes (or a single index)
+        :return: the corresponding elements representations
+        """
+        return self.elements[codes]
+
     def index_of(self, x):
         return self.element_to_index[x]
 
@@ -34,34 +75,43 @@ class Table:
 
     def of(self, *elements):
         c = self.coordinates_of(*elements)
-        return self.table[c]
+        return self.elements[self.table[c]]
+
+    def code_of(self, *elements):
+        return self.table[self.coordinates_of(*elements)]
 
     def at(self, *coordinates):
-        return self.table[tuple(coordinates)]
+        return self.elements[self.table[tuple(coordinates)]]
 
     def update(self, *elements, new):
-        self.table[self.coordinates_of(*elements)] = new
+        self.table[self.coordinates_of(*elements)] = self.index_of(new)
 
-    def unpad_table(self):
+    def unpad_codes(self):
         """
-        :return: self.table without padding
+        :return: view of self.table (the indexes) without padding
         """
         if self.has_been_padded:
             ind = tuple([slice(0, -1)] * self.ndim)
             return self.table[ind]
         return self.table
 
+    def unpad_table(self):
+        """
+        :return: the table of the elements representations, without padding
+        """
+        return self.decode(self.unpad_codes())
+
     def copy_table(self):
         """
         :return: a deep copy of self.table
         """
-        return copy(self.unpad_table())
+        return copy(self.unpad_codes())
 
     def copy(self):
         """
         :return: a deep copy of self
         """
-        return Table(self.copy_table(), self.elements, self.ndim, self.special_char)
+        return Table(self.copy_table(), self.elements, self.ndim, self.special_char, encoded=True)
 
     def __str__(self):
         return str(self.unpad_table())
@@ -70,46 +120,91 @@ class Table:
         return str(self)
 
 
+class CachedTermEvaluator(TermEvaluator):
+    def __init__(self, model, tables=None, check_cache=False, cache_sub=False):
+        """
+            TermEvaluator using the cache_manager of the model for the operation terms
+        :param check_cache: if True, look up every term in the cache before computing it
+        :param cache_sub: if True, cache every term not yet cached. The tables of the operation terms are then only
+        kept by the cache_manager (so within its memory budget), not in self.tables
+        """
+        super().__init__(model, tables)
+        self.check_cache = check_cache
+        self.cache_sub = cache_sub
+
+    def canonical_table(self, term):
+        cache_manager = self.model.cache_manager
+        if not term.is_operation() or (term.canonical in self.tables and not self.cache_sub):
+            return super().canonical_table(term)
+
+        if self.check_cache:
+            cached = cache_manager.lookup(term)
+        else:
+            cached = cache_manager.get_table(term) if self.cache_sub and cache_manager.is_cached(term) else None
+        if cached is not None:
+            if not self.cache_sub:
+                self.tables[term.canonical] = cached.unpad_codes()
+            return cached.unpad_codes()
+
+        if not self.cache_sub:
+            return super().canonical_table(term)
+
+        table = self.tables.pop(term.canonical, None)  # computed by an evaluator without cache_sub
+        if table is None:
+            table = self._compute(term)
+        cache_manager.cache(term, Table(table, self.model.elements, ndim=len(term.variables),
+                                        special_char=self.model.special_char, encoded=True))
+        if cache_manager.is_cached(term):
+            return cache_manager.get_table(term).unpad_codes()  # the copy of the cache, the only one kept
+        return table  # larger than the memory budget of the cache
+
+
 class TableMaker:
     def __init__(self, model):
         """
-            Create a Table given and expression
+            Create a Table given and expression. The expressions are added to a common TermDAG, so a subterm
+            shared by several expressions made by the same TableMaker (up to variable renaming) is computed once.
+            Don't reuse a TableMaker once the tables of the model have changed.
         """
         self.model = model
+        self.dag = TermDAG()
+        self.tables = {}  # canonical form -> table, shared by the evaluators of this TableMaker
 
-    def make_table(self, expr_, check_cache=False, cache_sub=False):
+    def make_table(self, expr_, check_cache=False, cache_sub=False, cache_expr=False):
         """
         WARNING : if the Expr is `Ax Ay Az x*y` this method will return a table of dim 2, avoiding
         unnecessary z dimension.
         :param expr_: Expr, expression to make a table with
         :param check_cache: optional use od model's cache_manager. If True, this method will check for every
         sub-expression if it's not already cached
-        :param cache_sub: if true, will cache every sub_expression not yet cached
+        :param cache_sub: if true, will cache every sub_expression not yet cached (expr_ included)
+        :param cache_expr: if true, will cache expr_ if not yet cached, but not its sub-expressions
         :return: the table of expr
         """
         parser = Parser()
         rpn = parser.expr_to_rpn(self.model, expr_)
-        table_function = self.model.arithmetic_function_generator.make(rpn)
-
-        ndim = 0
-        rpn_repr = [s.repr for s in rpn]
-        expr_variables = []
-        for v in expr_.variables:
-            if v.repr in rpn_repr:
-                ndim += 1
-                expr_variables.append(v)  # we need to preserve the order
-        table_array = empty([self.model.cardinal] * ndim)
-        table = Table(table_array, self.model.elements, ndim=ndim, special_char=self.model.special_char)
-
-        if check_cache:
-            warn("Warning : check_cache not supported yet")
-        if cache_sub:
-            warn("Warning : cache_sub not supported yet")
-
-        for variable_instances in product(self.model.elements, repeat=ndim):
-            val = table_function(
-                **{expr_variables[i].repr: variable_instances[i] for i in range(ndim)}
-            )
-            table.update(*variable_instances, new=val)
-
-        return table
+        term = self.dag.add_rpn(rpn)
+
+        # we need to preserve the order of the quantifiers
+        expr_variables = tuple(v.repr for v in expr_.variables if v.repr in term.variables)
+        ndim = len(expr_variables)
+        shape = [self.model.cardinal] * ndim
+
+        evaluator = CachedTermEvaluator(self.model, self.tables, check_cache, cache_sub)
+        table_array = broadcast_to(evaluator.table_on(term, expr_variables), shape)
+        cache_manager = self.model.cache_manager
+        if cache_expr and term.is_operation() and not cache_manager.is_cached(term):
+            cache_manager.cache(term, Table(evaluator.canonical_table(term), self.model.elements,
+                                            ndim=len(term.variables), special_char=self.model.special_char,
+                                            encoded=True))
+        return Table(table_array, self.model.elements, ndim=ndim, special_char=self.model.special_char,
+                     encoded=True)
+
+    def make_term_table(self, term):
+        """
+        :param term: Term to make a table with
+        :return: the table of term, with one dimension per variable of term.variables
+        """
+        table_array = TermEvaluator(self.model, self.tables).canonical_table(term)
+        return Table(table_array, self.model.elements, ndim=len(term.variables),
+                     special_char=self.model.special_char, encoded=True)